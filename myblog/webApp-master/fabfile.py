@@ -59,6 +59,8 @@ def build():
     excludes = ['test', '.*', '*.pyc', '*.pyo']
     local('rm -f dist/%s' % _TAR_FILE)
     with lcd(os.path.join(_current_path(), 'www')):
+        # 静态文件预先压缩成 .gz / .br 一起打包，运行时直接发送
+        local('python compress.py static')
         cmd = ['tar', '--dereference', '-czvf', '../dist/%s' % _TAR_FILE] # 打包命令
         cmd.extend(['--exclude=\'%s\'' % ex for ex in excludes])
         cmd.extend(includes)
@@ -5,7 +5,7 @@ __author__ = 'Eric Lee'
 Json API definition
 '''
 
-import json, logging, inspect, functools
+import json, logging, inspect, functools, base64
 
 class Page(object):
     """
@@ -57,6 +57,22 @@ class Page(object):
             self.limit = (item_count-self.offset) if (item_count-self.offset) < page_size else  self.offset + self.page_size
         self.has_next = self.page_index < self.page_count
         self.has_previous = self.page_index > 1
+        # keyset 分页的下一页游标，由 set_cursor() 填写
+        self.next_cursor = None
+
+    def set_cursor(self, items, after=False):
+        '''
+        Use the last item (ordered by created_at desc, id desc) as the cursor of next page.
+        after=True for a page read after a cursor: its position is unknown, so page_index, offset
+        and limit are None, and there is a next page only if this one is full.
+        '''
+        if after:
+            self.page_index = self.offset = self.limit = None
+            self.has_previous = True
+            self.has_next = len(items) == self.page_size
+        if items and self.has_next:
+            last = items[-1]
+            self.next_cursor = encode_cursor(last.created_at, last.id)
 
     def __str__(self):
         return 'item_count: %s, page_count: %s, page_index: %s, page_size: %s, offset:%s, limit:%s' \
@@ -64,6 +80,29 @@ class Page(object):
 
     __repr__ = __str__ # 机器和人看到的一样 （print 调用__str__, python解析器回车调用__repr__）
 
+def json_default(o):
+    '''
+    Fallback of json.dumps: ORM rows by to_dict(), other objects (e.g. Page) by __dict__.
+    '''
+    to_dict = getattr(o, 'to_dict', None)
+    if to_dict is not None:
+        return to_dict()
+    return o.__dict__
+
+# 游标对客户端是不透明的：(created_at, id) 的 json 再做 urlsafe base64
+def encode_cursor(created_at, id):
+    return base64.urlsafe_b64encode(json.dumps([created_at, id]).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    '''
+    Decode cursor to (created_at, id) for findAll(after=...).
+    '''
+    try:
+        created_at, id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        return float(created_at), str(id)
+    except (ValueError, TypeError) as e:
+        raise APIValueError('cursor', 'Invalid cursor.')
+
 class APIError(Exception):
     '''
     the base APIError which contains error(required), data(optional) and message(optional).
@@ -1,16 +1,18 @@
 #coding:utf-8
 import logging; logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(name)s:%(levelname)s: %(message)s")
 
-import asyncio, os, json, time
+import asyncio, os, time
 from datetime import datetime
 
 from aiohttp import web
 # FileSystemLoader是文件系统加载器，用来加载模板路径
 from jinja2 import Environment, FileSystemLoader
 import orm
+from config import configs
 from models import User, Blog, Comment
-from coroweb import add_routes, add_static
+from coroweb import add_routes, add_static, register_json, dumps_async, response_cache, route_cache, add_validators, conditional, compress_response
 from handlers import cookie2user, COOKIE_NAME
+from apis import Page
 import handlers
 
 
@@ -41,47 +43,92 @@ def init_jinja2(app, **kw):
     app['__templating__'] = env
 
 # 这个函数的作用就是当有http请求的时候，通过logging.info输出请求的信息，其中包括请求的方法和路径
-@asyncio.coroutine
-def logger_factory(app, handler):
-    @asyncio.coroutine
-    def logger(request):
+async def logger_factory(app, handler):
+    async def logger(request):
         logging.info('Request: %s %s ' % (request.method, request.path))
-        return (yield from  handler(request))
+        return await handler(request)
     return logger
 
+# 读写分离：POST 请求以及 POST 之后 REPLICA_LAG 秒内同一浏览器的请求都从主库读，保证能读到自己刚写的数据
+READ_PRIMARY_COOKIE = 'myblogrw'
+REPLICA_LAG = 5
+
+async def replica_factory(app, handler):
+    async def route(request):
+        pinned = request.method == 'POST' or bool(request.cookies.get(READ_PRIMARY_COOKIE))
+        # 同一个 keep-alive 连接的请求在同一个 task 里处理，结束时要恢复
+        token = orm.pin_primary(pinned)
+        try:
+            r = await handler(request)
+        finally:
+            orm.unpin_primary(token)
+        if request.method == 'POST' and isinstance(r, web.StreamResponse):
+            r.set_cookie(READ_PRIMARY_COOKIE, '1', max_age=REPLICA_LAG, httponly=True)
+        return r
+    return route
+
 # auth认证拦截器
-@asyncio.coroutine
-def auth_factory(app, handler):
-    @asyncio.coroutine
-    def auth(request):
+async def auth_factory(app, handler):
+    async def auth(request):
         logging.info('check user: %s %s' % (request.method, request.path))
         request.__user__ = None
         cookie_str = request.cookies.get(COOKIE_NAME)
         if cookie_str:
-            user = yield from cookie2user(cookie_str)
+            user = await cookie2user(cookie_str)
             print(user)
             if user:
                 logging.info('set current user: %s' % user.email)
                 request.__user__ = user
         if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
             return web.HTTPFound('/signin')
-        return (yield from handler(request))
+        return await handler(request)
     return auth
 
-@asyncio.coroutine
-def data_factory(app, handler):
-    @asyncio.coroutine
-    def parse_data(request):
+# 响应缓存：在 auth 之后 (vary 可以按用户)，缓存 response_factory 生成的最终响应
+async def cache_factory(app, handler):
+    async def cache(request):
+        policy = route_cache(request) if request.method == 'GET' else None
+        if policy is None:
+            return await handler(request)
+        return await response_cache.respond(request, policy, handler)
+    return cache
+
+# 条件 GET：validator_factory 给响应加上 ETag (在缓存里面，缓存的响应也带着)，
+# conditional_factory 在缓存外面，客户端已有最新的就回 304
+async def validator_factory(app, handler):
+    async def validate(request):
+        return add_validators(request, await handler(request))
+    return validate
+
+async def conditional_factory(app, handler):
+    async def check(request):
+        return conditional(request, await handler(request))
+    return check
+
+# 压缩在缓存里面、ETag 外面：缓存的是压缩后的响应，ETag 按原始内容计算
+async def compress_factory(app, handler):
+    async def compress(request):
+        return compress_response(request, await handler(request))
+    return compress
+
+async def data_factory(app, handler):
+    async def parse_data(request):
         if request.method == 'POST':
             if request.content_type.startswith('application/json'):
-                request.__data__ = yield from request.json()
+                request.__data__ = await request.json()
                 logging.info('request json: %s' % str(request.__data__))
             elif request.content_type.startswith('application/x-www-form-urlencoded'):
-                request.__data__ = yield from request.post()
+                request.__data__ = await request.post()
                 logging.info('request from : %s ' % str(request.__data__))
-        return (yield from handler(request))
+        return await handler(request)
     return parse_data
 
+# JSON：行对象用模型生成的 to_dict()，分页对象直接取属性
+register_json(orm.ModelRow, lambda row: row.to_dict())
+register_json(Page, vars)
+# 缓存的响应按 ORM 每张表的写入版本区分，写表之后旧的响应不会再被命中
+response_cache.version = orm.query_cache.version
+
 # 请求对象request的处理工序流水线先后依次是：
 #     	logger_factory->auth_factory->response_factory->RequestHandler().__call__->get或post->handler
 # 对应的响应对象response的处理工序流水线先后依次是:
@@ -91,16 +138,14 @@ def data_factory(app, handler):
 # response_factory在拿到经过处理后的对象，经过一系列类型判断，构造出正确web.Response对象，以正确的方式返回给客户端
 # 在这个过程中，只关心handler的处理，其他的都走统一通道，如果需要差异化处理，就在通道中选择适合的地方添加处理代码。
 # 注：在response_factory中应用了jinja2来渲染模板文件
-@asyncio.coroutine
-def response_factory(app, handler):
-    @asyncio.coroutine
-    def response(request):
+async def response_factory(app, handler):
+    async def response(request):
         logging.info('Response handler : %s...' % handler)
         # app.router.add_route(method, path, RequestHandler(app, fn))
         # 从 handlers 的每个函数返回的值(这里的 handler是 RequestHandler（app, fn）)
         # 调用 handler(request) 就是 __call__(self, request)
         # fn 就是 handlers 里面对应的函数
-        r = yield from handler(request)
+        r = await handler(request)
         logging.info('Response result = %s' % r)
         if isinstance(r, web.StreamResponse):
             return r
@@ -114,11 +159,13 @@ def response_factory(app, handler):
             resp = web.Response(body=r.encode('utf-8'))
             resp.content_type = 'text/html;charset=utf-8'
             return resp
+        if isinstance(r, orm.ModelRow):
+            r = r.to_dict()
         if isinstance(r, dict):
             template = r.get('__template__')
             if template is None:
                 # dumps:dict转化成str格式
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o:o.__dict__).encode('utf-8'))
+                resp = web.Response(body=await dumps_async(r))
                 resp.content_type = 'text/html;charset=utf-8'
                 return resp
             else:
@@ -154,10 +201,12 @@ def datetime_filter(t):
 #def index(requset):
 #   return web.Response(content_type='text/html', body=b'<h1>Awesome</h1>')
 
-@asyncio.coroutine
-def init(loop):
+async def init(loop, host='127.0.0.1', port=9000):
     # 连接 ORM
-    yield from orm.create_pool(loop=loop,user='root', password='root', db='awesome')
+    await orm.create_pool(loop=loop, **configs.db)
+    # 列表页的总数来自计数器：启动时校正一次，之后定期校正
+    await orm.reconcile_counters()
+    asyncio.ensure_future(orm.keep_counters(), loop=loop)
     # summary = "Try something new," \
     #           " lead to the new life."
     #
@@ -167,25 +216,27 @@ def init(loop):
     #     Blog(id='3', user_id='3',user_name='Learn Swift',user_image='about:blank',  name='33', content='B3', summary=summary, created_at=time.time() - 7200)
     # ]
     # for blog in blogs:
-    #     yield from blog.save()
+    #     await blog.save()
 
     # 创建Web服务器实例app，也就是aiohttp.web.Application类的实例，该实例的作用是处理URL、HTTP协议
-    app = web.Application(loop=loop, middlewares=[logger_factory, auth_factory, response_factory])
+    app = web.Application(loop=loop, middlewares=[logger_factory, replica_factory, auth_factory, conditional_factory, cache_factory, compress_factory, validator_factory, response_factory])
     # 为 app 添加 __templating__ 参数
     init_jinja2(app, filters=dict(datetime=datetime_filter))
     # url处理函数， 对 aiohttp 的http 响应进行处理
     add_routes(app, 'handlers')
     # app.router.add_route('GET', '/', index)#增加协程,异步io
     add_static(app)
-    srv = yield from loop.create_server(app.make_handler(), '127.0.0.1', 9000)
-    logging.info('server start at http://127.0.0.1:9000...')
+    srv = await loop.create_server(app.make_handler(), host, port)
+    logging.info('server start at http://%s:%s...' % (host, port))
     return srv #返回服务器
 
 # loop为Eventloop用来处理HTTP请求
 # 异步io事件的句柄, 创建协程
-loop = asyncio.get_event_loop() #寻找@asyncio.coroutine后里面的异步io事件
-loop.run_until_complete(init(loop))
-loop.run_forever() # 知道调用stop()或认为中断
+# benchweb.py 会 import 本模块，只在直接运行时启动服务器
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop() #寻找@asyncio.coroutine后里面的异步io事件
+    loop.run_until_complete(init(loop))
+    loop.run_forever() # 知道调用stop()或认为中断
 
 # asyncio:  异步 IO 模块创建服务协程，监听相应端口
 # aiohttp:  异步 Web 开发框架，处理 HTTP 请求，构建并返回 HTTP 响应
\ No newline at end of file
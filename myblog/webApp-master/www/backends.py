@@ -0,0 +1,270 @@
+#coding:utf-8
+
+__author__ = 'Eric Lee'
+
+'''
+Database backends used by orm.create_pool(engine=...).
+
+A backend provides create_pool(loop, **kw) returning a pool with the aiomysql pool interface
+(async with pool.acquire() as conn, await acquire()/release(), size/freesize/minsize/maxsize), the cursor classes
+passed to conn.cursor(), and the prefix used to EXPLAIN a statement.
+'''
+
+import os, re, asyncio, logging, sqlite3, functools, collections
+
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None # 只用 sqlite 时不需要
+
+class MySQLBackend(object):
+    name = 'mysql'
+    explain_prefix = 'explain '
+    # orm 的计数器：加上一个差值 / 设成一个值，没有这一行时插入
+    counter_add = 'insert into `counters` (`name`, `value`) values (%s, %s) on duplicate key update `value`=`value`+values(`value`)'
+    counter_set = 'insert into `counters` (`name`, `value`) values (%s, %s) on duplicate key update `value`=values(`value`)'
+    # 已经部署的库里没有计数器表 (sql.sql 会删库重建，不能用来升级)
+    counters_ddl = ('create table if not exists `counters` (`name` varchar(100) not null, `value` bigint not null, '
+                    'primary key (`name`)) engine=innodb default charset=utf8')
+
+    def __init__(self):
+        if aiomysql is None:
+            raise RuntimeError('aiomysql is required by the mysql engine')
+        self.dict_cursor = aiomysql.DictCursor
+        self.ss_cursor = aiomysql.SSDictCursor
+
+    # 现有的索引 (不含主键)：[(表名, 索引名, (列, ...), 是否唯一)]
+    async def indexes(self, conn, tables):
+        cur = await conn.cursor(self.dict_cursor)
+        await cur.execute('select `table_name` as `t`, `index_name` as `i`, `column_name` as `c`, `non_unique` as `n` '
+                               'from information_schema.statistics where `table_schema`=database() and `index_name`<>%%s '
+                               'and `table_name` in (%s) order by `t`, `i`, `seq_in_index`' % ','.join(['%s'] * len(tables)),
+                               ['PRIMARY'] + list(tables))
+        rs = await cur.fetchall()
+        await cur.close()
+        found = collections.OrderedDict()
+        for r in rs:
+            found.setdefault((r['t'], r['i']), ([], not r['n']))[0].append(r['c'])
+        return [(t, i, tuple(columns), unique) for (t, i), (columns, unique) in found.items()]
+
+    def add_index_ddl(self, table, name, columns, unique):
+        return 'alter table `%s` add %sindex `%s` (%s);' % (table, 'unique ' if unique else '', name, ','.join('`%s`' % c for c in columns))
+
+    def drop_index_ddl(self, table, name):
+        return 'alter table `%s` drop index `%s`;' % (table, name)
+
+    async def create_pool(self, loop, **kw):
+        return (await aiomysql.create_pool(
+            host=kw.get('host', 'localhost'),
+            port=kw.get('port', 3306),
+            user=kw.get('user','root'),
+            password=kw.get('password',''),
+            db=kw.get('db','testdb'),
+            charset=kw.get('charset', 'utf8'),
+            autocommit=kw.get('autocommit', True),
+            maxsize=kw.get('maxsize', 10),
+            minsize=kw.get('minsize', 1),
+            loop=loop
+        ))
+
+# ------------------------------------ 进程内的 SQLite ------------------------------------
+# 把 sql.sql 的 MySQL 建表语句翻译成 SQLite 的：去掉 database/use/engine，key 变成单独的 create index
+_RE_CREATE_TABLE = re.compile(r'^create\s+table\s+`?(\w+)`?\s*\((.*)\)[^)]*$', re.S | re.I)
+_RE_KEY = re.compile(r'^(unique\s+)?key\s+`?(\w+)`?\s*\((.+)\)$', re.I)
+
+def translate_ddl(text):
+    '''
+    Translate MySQL DDL (as in sql.sql) to a list of SQLite statements.
+    >>> translate_ddl("create table t (`id` varchar(50) not null, key `idx_a` (`a`), primary key (`id`)) engine=innodb;")
+    ['create table if not exists `t` (\\n    `id` varchar(50) not null,\\n    primary key (`id`)\\n)', 'create index if not exists `t_idx_a` on `t` (`a`)']
+    '''
+    L = []
+    for stmt in text.split(';'):
+        lines = [l.strip() for l in stmt.splitlines() if l.strip() and not l.strip().startswith('--')]
+        m = _RE_CREATE_TABLE.match(' '.join(lines))
+        if m is None:
+            continue # drop/create database, use, grant 在 SQLite 里没有意义
+        table, body = m.group(1), m.group(2)
+        columns, indexes = [], []
+        # 按顶层逗号切分列定义
+        depth, part, parts = 0, [], []
+        for ch in body:
+            if ch == ',' and depth == 0:
+                parts.append(''.join(part).strip())
+                part = []
+                continue
+            depth += {'(': 1, ')': -1}.get(ch, 0)
+            part.append(ch)
+        parts.append(''.join(part).strip())
+        for item in parts:
+            km = _RE_KEY.match(item)
+            if km:
+                # SQLite 的索引名在整个库里唯一，加上表名
+                indexes.append('create %sindex if not exists `%s_%s` on `%s` (%s)' % ('unique ' if km.group(1) else '', table, km.group(2), table, km.group(3)))
+            elif item:
+                columns.append(item)
+        L.append('create table if not exists `%s` (\n    %s\n)' % (table, ',\n    '.join(columns)))
+        L.extend(indexes)
+    return L
+
+# orm 编译出来的是 aiomysql 的 %s 占位符
+@functools.lru_cache(maxsize=256)
+def _sqlite_sql(sql):
+    return sql.replace('%s', '?')
+
+class SQLiteCursor(object):
+    def __init__(self, db):
+        self._cur = db.cursor()
+        self.rowcount = -1
+
+    def _rows(self, rs):
+        names = [d[0] for d in self._cur.description or ()]
+        return [dict(zip(names, r)) for r in rs]
+
+    async def execute(self, sql, args=()):
+        self._cur.execute(_sqlite_sql(sql), tuple(args or ()))
+        self.rowcount = self._cur.rowcount
+
+    async def fetchall(self):
+        return self._rows(self._cur.fetchall())
+
+    async def fetchmany(self, size):
+        return self._rows(self._cur.fetchmany(size))
+
+    async def close(self):
+        self._cur.close()
+
+class SQLiteConnection(object):
+    def __init__(self, db):
+        self._db = db
+        self.closed = False
+
+    async def cursor(self, cursor_class=None):
+        return SQLiteCursor(self._db)
+
+    async def begin(self):
+        self._db.execute('begin')
+
+    async def commit(self):
+        if self._db.in_transaction:
+            self._db.execute('commit')
+
+    async def rollback(self):
+        if self._db.in_transaction:
+            self._db.execute('rollback')
+
+    # ModelStream 放弃读到一半的结果时会关闭连接；SQLite 的游标直接丢掉就行，连接(和内存里的库)要留着
+    def close(self):
+        pass
+
+# 和 aiomysql 一样：await pool.acquire() 得到连接，async with pool.acquire() as conn 用完自动归还
+class _AcquireContext(object):
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = None
+
+    def __await__(self):
+        return self._pool._acquire().__await__()
+
+    async def __aenter__(self):
+        self._conn = await self._pool._acquire()
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        conn, self._conn = self._conn, None
+        await self._pool.release(conn)
+
+class SQLitePool(object):
+    '''
+    One sqlite3 connection used in the event loop thread. SQLite serializes writers anyway,
+    so the pool holds a single connection and waiters queue for it.
+    Do not run other queries on the same task while holding a ModelStream open.
+    '''
+    minsize = maxsize = size = 1
+
+    def __init__(self, db):
+        self._conn = SQLiteConnection(db)
+        self._in_use = False
+        self._waiters = collections.deque()
+
+    @property
+    def freesize(self):
+        return 0 if self._in_use else 1
+
+    def acquire(self):
+        return _AcquireContext(self)
+
+    async def _acquire(self):
+        while self._in_use:
+            fut = asyncio.get_event_loop().create_future()
+            self._waiters.append(fut)
+            await fut
+        self._in_use = True
+        return self._conn
+
+    def release(self, conn):
+        self._in_use = False
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                break
+        done = asyncio.get_event_loop().create_future()
+        done.set_result(None)
+        return done
+
+class SQLiteBackend(object):
+    name = 'sqlite'
+    explain_prefix = 'explain query plan '
+    counter_add = 'insert into `counters` (`name`, `value`) values (%s, %s) on conflict(`name`) do update set `value`=`value`+excluded.`value`'
+    counter_set = 'insert into `counters` (`name`, `value`) values (%s, %s) on conflict(`name`) do update set `value`=excluded.`value`'
+    counters_ddl = 'create table if not exists `counters` (`name` varchar(100) not null, `value` bigint not null, primary key (`name`))'
+    dict_cursor = None
+    ss_cursor = None
+
+    async def indexes(self, conn, tables):
+        cur = await conn.cursor()
+        L = []
+        for t in tables:
+            await cur.execute('pragma index_list(`%s`)' % t)
+            for r in (await cur.fetchall()):
+                if r['origin'] == 'pk':
+                    continue
+                await cur.execute('pragma index_info(`%s`)' % r['name'])
+                columns = tuple(c['name'] for c in sorted((await cur.fetchall()), key=lambda c: c['seqno']))
+                L.append((t, r['name'], columns, bool(r['unique'])))
+        await cur.close()
+        return L
+
+    # 索引名在整个库里唯一，和 translate_ddl 一样加上表名
+    def add_index_ddl(self, table, name, columns, unique):
+        return 'create %sindex `%s_%s` on `%s` (%s);' % ('unique ' if unique else '', table, name, table, ','.join('`%s`' % c for c in columns))
+
+    def drop_index_ddl(self, table, name):
+        return 'drop index `%s`;' % name
+
+    async def create_pool(self, loop, **kw):
+        '''
+        database: file name or ':memory:'; schema: MySQL DDL file, default sql.sql next to this module.
+        '''
+        database = kw.get('database', ':memory:')
+        schema = kw.get('schema', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sql.sql'))
+        logging.info('create sqlite database %s from %s' % (database, schema))
+        pool = SQLitePool(sqlite3.connect(database, isolation_level=None))
+        # 建表也走连接池
+        if schema:
+            with open(schema, encoding='utf-8') as f:
+                ddl = translate_ddl(f.read())
+            async with pool.acquire() as conn:
+                cur = await conn.cursor()
+                for stmt in ddl:
+                    await cur.execute(stmt)
+                await cur.close()
+        return pool
+
+_backends = dict(mysql=MySQLBackend, sqlite=SQLiteBackend)
+
+def get_backend(engine):
+    if engine not in _backends:
+        raise ValueError('Invalid database engine: %s' % engine)
+    return _backends[engine]()
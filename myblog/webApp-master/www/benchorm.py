@@ -0,0 +1,175 @@
+#coding:utf-8
+
+__author__ = 'Eric Lee'
+
+'''
+ORM micro-benchmark: 默认只测 ORM 在 Python 侧的 CPU 开销；python benchorm.py db 连接 configs.db 测实际读写
+'''
+
+import sys, time, timeit, asyncio, tracemalloc
+
+import orm
+from config import configs
+from models import User, Blog, Comment
+
+N = 100000
+
+def report(name, old, new):
+    print('%-36s old: %6.2f us/query   new: %6.2f us/query   saved: %6.2f us' % (name, old * 1e6 / N, new * 1e6 / N, (old - new) * 1e6 / N))
+
+# ---------------------------------- 编译后的语句 ----------------------------------
+# 原来每次查询都要拼接语句，再 sql.replace('?', '%s')
+def old_find_all(cls, where=None, args=None, **kw):
+    sql = [cls.__select__]
+    if where:
+        sql.append('where')
+        sql.append(where)
+    if args is None:
+        args = []
+    orderBy = kw.get('orderBy', None)
+    if orderBy:
+        sql.append('order by')
+        sql.append(orderBy)
+    limit = kw.get('limit', None)
+    if limit is not None:
+        sql.append('limit')
+        if isinstance(limit, int):
+            sql.append('?')
+            args.append(limit)
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            sql.append('?,?')
+            args.extend(limit)
+    return ' '.join(sql).replace('?', '%s'), args
+
+def old_find_number(cls, selectField, where=None):
+    sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
+    if where:
+        sql.append('where')
+        sql.append(where)
+    return ' '.join(sql).replace('?', '%s')
+
+def new_find_all(cls, where=None, args=None, **kw):
+    args = list(args) if args else []
+    limit = kw.get('limit', None)
+    kind = 0
+    if isinstance(limit, int):
+        kind = 1
+        args.append(limit)
+    elif isinstance(limit, tuple):
+        kind = 2
+        args.extend(limit)
+    return orm._find_all_sql(cls, where, kw.get('orderBy', None), kind), args
+
+def new_find_number(cls, selectField, where=None):
+    return orm._find_number_sql(cls, selectField, where)
+
+def bench_statements():
+    # 首页 '/': findNumber + findAll(limit=(0, 5))
+    old = timeit.timeit(lambda: (old_find_number(Blog, 'count(id)'), old_find_all(Blog, orderBy='created_at desc', limit=(0, 5))), number=N)
+    new = timeit.timeit(lambda: (new_find_number(Blog, 'count(id)'), new_find_all(Blog, orderBy='created_at desc', limit=(0, 5))), number=N)
+    report('index statements', old, new)
+    # '/api/blogs?page=3'
+    old = timeit.timeit(lambda: (old_find_number(Blog, 'count(id)'), old_find_all(Blog, orderBy='created_at desc', limit=(20, 10))), number=N)
+    new = timeit.timeit(lambda: (new_find_number(Blog, 'count(id)'), new_find_all(Blog, orderBy='created_at desc', limit=(20, 10))), number=N)
+    report('/api/blogs statements', old, new)
+    # Blog.find(id) / Blog.save()
+    old = timeit.timeit(lambda: ('%s where `%s`=?' % (Blog.__select__, Blog.__primary_key__)).replace('?', '%s'), number=N)
+    new = timeit.timeit(lambda: Blog.__compiled__['find'], number=N)
+    report('find(pk) statement', old, new)
+    old = timeit.timeit(lambda: Blog.__insert__.replace('?', '%s'), number=N)
+    new = timeit.timeit(lambda: Blog.__compiled__['insert'], number=N)
+    report('save() statement', old, new)
+
+# ---------------------------------- 行对象 ----------------------------------
+def comment_rows(n):
+    return [dict(id='%050d' % i, blog_id='b' * 50, user_id='u' * 50, user_name='Test', user_image='about:blank',
+                 content='comment %s' % i, created_at=1500000000.0 + i) for i in range(n)]
+
+def measure(fn, rs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    objs = fn(rs)
+    elapsed = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # 访问属性：模板和 handlers 的主要用法
+    start = time.perf_counter()
+    for o in objs:
+        o.content, o.user_name, o.created_at
+    return elapsed, size, time.perf_counter() - start
+
+def bench_rows(n=100000):
+    rs = comment_rows(n)
+    old = measure(lambda rs: [Comment(**r) for r in rs], rs)
+    new = measure(Comment._hydrate, rs)
+    for name, i, unit, scale in (('hydrate', 0, 'ms', 1e3), ('memory', 1, 'bytes/row', 1.0 / n), ('attribute access', 2, 'ms', 1e3)):
+        print('%-36s old: %10.1f %-9s new: %10.1f %s' % ('%s %s Comment rows' % (name, n), old[i] * scale, unit, new[i] * scale, unit))
+
+# ---------------------------------- 建类时生成的函数 ----------------------------------
+# 原来 save()/update() 对每列调用 getValueOrDefault/getValue，读出的行逐列 setattr
+def old_insert_args(obj):
+    args = list(map(obj.getValueOrDefault, obj.__fields__))
+    args.append(obj.getValueOrDefault(obj.__primary_key__))
+    return args
+
+def old_update_args(obj):
+    args = list(map(obj.getValue, obj.__fields__))
+    args.append(obj.getValue(obj.__primary_key__))
+    return args
+
+def old_hydrate(cls, rs):
+    from_dict = cls.__row__._from_dict
+    return [from_dict(r) for r in rs]
+
+def blog_row():
+    return dict(id='%050d' % 1, user_id='u' * 50, user_name='Test', user_image='about:blank', name='Test Blog',
+                summary='summary', content='content ' * 100, created_at=1500000000.0)
+
+def bench_codegen():
+    for cls, r in ((Blog, blog_row()), (Comment, comment_rows(1)[0])):
+        rs = [r] * 1000
+        old = timeit.timeit(lambda: old_hydrate(cls, rs), number=N // 1000)
+        new = timeit.timeit(lambda: cls._hydrate(rs), number=N // 1000)
+        report('%s hydrate (per row)' % cls.__name__, old, new)
+        obj = cls(**r) # save() 的新对象
+        old = timeit.timeit(lambda: old_insert_args(obj), number=N)
+        new = timeit.timeit(lambda: obj.__insert_args__(), number=N)
+        report('%s save() args' % cls.__name__, old, new)
+        row = cls._hydrate([r])[0] # update() 的行对象
+        old = timeit.timeit(lambda: old_update_args(row), number=N)
+        new = timeit.timeit(lambda: row.__update_args__(), number=N)
+        report('%s update() args' % cls.__name__, old, new)
+
+# ---------------------------------- 以下需要数据库 ----------------------------------
+def make_comments(n):
+    return [Comment(blog_id='bench', user_id='bench', user_name='bench', user_image='about:blank', content='comment %s' % i) for i in range(n)]
+
+async def bench_save_many(n=100000):
+    rows = make_comments(n // 10)
+    start = time.time()
+    for c in rows:
+        await c.save()
+    old = len(rows) / (time.time() - start)
+    rows = make_comments(n)
+    start = time.time()
+    await Comment.save_many(rows)
+    new = len(rows) / (time.time() - start)
+    print('%-36s save(): %10.0f rows/s   save_many(): %10.0f rows/s   x%.1f' % ('%s Comment inserts' % n, old, new, new / old))
+    await orm.transaction().run(_remove_bench_comments)
+
+# Comment 有计数，直接 delete 之后要把计数减回去，和 handlers._remove_blog 一样
+async def _remove_bench_comments():
+    n = await orm.execute('delete from `comments` where `blog_id`=?', ['bench'])
+    await orm.add_counters([(Comment.counter(), -n), (Comment.counter(blog_id='bench'), -n)])
+
+async def bench_db(loop):
+    await orm.create_pool(loop=loop, **configs.db)
+    await bench_save_many()
+
+if __name__ == '__main__':
+    bench_statements()
+    bench_rows()
+    bench_codegen()
+    if 'db' in sys.argv[1:]:
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(bench_db(loop))
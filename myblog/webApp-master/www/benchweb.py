@@ -0,0 +1,155 @@
+#coding:utf-8
+
+__author__ = 'Eric Lee'
+
+'''
+Web throughput benchmark: 用进程内的 SQLite 启动整个应用，不需要 MySQL。
+先不经过网络比较 yield from 和 async/await 每个请求的调度开销，再用 HTTP 压整个应用。
+python benchweb.py [requests] [concurrency]
+'''
+
+import sys, time, asyncio, logging
+
+import aiohttp
+
+import orm
+from config import configs
+from models import User, Blog, Comment
+
+HOST, PORT = '127.0.0.1', 9100
+BLOGS = 50
+COMMENTS_PER_BLOG = 10
+
+async def seed():
+    user = User(name='bench', email='bench@example.com', passwd='x' * 40, image='about:blank')
+    await user.save()
+    blogs = [Blog(user_id=user.id, user_name=user.name, user_image=user.image, name='Blog %s' % i,
+                  summary='summary %s' % i, content='content %s ' % i * 100, created_at=time.time() - i) for i in range(BLOGS)]
+    await Blog.save_many(blogs)
+    await Comment.save_many([Comment(blog_id=b.id, user_id=user.id, user_name=user.name, user_image=user.image,
+                                     content='comment %s' % i) for b in blogs for i in range(COMMENTS_PER_BLOG)])
+    return blogs
+
+async def run(call, n, concurrency):
+    todo = [n]
+    async def worker():
+        while todo[0] > 0:
+            todo[0] -= 1
+            await call()
+    start = time.time()
+    await asyncio.gather(*[worker() for i in range(concurrency)])
+    return time.time() - start
+
+def report(name, n, seconds):
+    print('%-36s %10.0f req/s %8.1f us/req' % (name, n / seconds, seconds / n * 1e6))
+
+# ---------------------------------- 调度开销 ----------------------------------
+# 一个请求经过 4 层中间件、RequestHandler、处理函数、Model.find、_select 这么多层协程，
+# 叶子上等一次事件循环 (相当于一次 I/O)；同样的层数分别用生成器 + yield from 和 async def + await 写
+DEPTH = 8
+
+def legacy_chain(depth):
+    import coroweb
+    @coroweb.coroutine
+    def leaf():
+        yield from asyncio.sleep(0)
+        return 1
+    def layer(inner):
+        @coroweb.coroutine
+        def call():
+            return (yield from inner())
+        return call
+    fn = leaf
+    for i in range(depth):
+        fn = layer(fn)
+    return fn
+
+def native_chain(depth):
+    async def leaf():
+        await asyncio.sleep(0)
+        return 1
+    def layer(inner):
+        async def call():
+            return await inner()
+        return call
+    fn = leaf
+    for i in range(depth):
+        fn = layer(fn)
+    return fn
+
+class FakeRequest(object):
+    method = 'GET'
+    content_type = ''
+
+    def __init__(self, path, match_info=None, query_string=''):
+        self.path = path
+        self.match_info = match_info or {}
+        self.query_string = query_string
+        self.cookies = {}
+        self.headers = {}
+
+# 真实的中间件和 RequestHandler，不经过 aiohttp 的服务器
+async def through_middlewares(fn):
+    import app, coroweb
+    handler = coroweb.RequestHandler(None, fn)
+    for factory in (app.response_factory, app.auth_factory, app.replica_factory, app.logger_factory):
+        handler = await factory(None, handler)
+    return handler
+
+async def bench_dispatch(blogs, n, concurrency):
+    import handlers
+    for name, chain in (('yield from chain', legacy_chain(DEPTH)), ('async/await chain', native_chain(DEPTH))):
+        report('%s (depth %s)' % (name, DEPTH), n, await run(chain, n, concurrency))
+    # 旧写法的处理函数走 coroweb 的兼容层
+    async def native_get_blog(*, id):
+        blog = await Blog.find(id)
+        return blog
+    request = FakeRequest('/api/blogs/%s' % blogs[0].id, dict(id=blogs[0].id))
+    for name, fn in (('yield from handler', handlers.api_get_blog), ('async def handler', native_get_blog)):
+        handler = await through_middlewares(fn)
+        report('%s (GET /api/blogs/{id})' % name, n, await run(lambda: handler(request), n, concurrency))
+    handler = await through_middlewares(handlers.api_blogs)
+    request = FakeRequest('/api/blogs', query_string='page=2')
+    report('dispatch GET /api/blogs?page=2', n, await run(lambda: handler(request), n, concurrency))
+
+# /api/blogs 一页的编码：原来的 json.dumps + apis.json_default 和 coroweb.dumps (注册的编码函数，有 orjson 时用它)
+async def bench_json(n):
+    import json, app, coroweb
+    from apis import Page, json_default
+    blogs = await Blog.findAll(limit=10, columns=Blog.summary_view, preload_counts=['comments'])
+    r = dict(page=Page(BLOGS, 1), blogs=blogs)
+    for name, dumps in (('json.dumps + json_default', lambda: json.dumps(r, ensure_ascii=False, default=json_default).encode('utf-8')),
+                        ('coroweb.dumps (%s)' % ('orjson' if coroweb.orjson else 'json'), lambda: coroweb.dumps(r))):
+        start = time.time()
+        for i in range(n):
+            dumps()
+        report(name, n, time.time() - start)
+
+async def drive(session, url, n, concurrency):
+    async def get():
+        r = await session.get(url)
+        await r.read()
+        assert r.status == 200, '%s: %s' % (url, r.status)
+    return n / await run(get, n, concurrency)
+
+async def bench(loop, n, concurrency):
+    import app
+    configs.db = dict(engine='sqlite')
+    await app.init(loop, HOST, PORT)
+    blogs = await seed()
+    await bench_dispatch(blogs, n, concurrency)
+    await bench_json(n)
+    session = aiohttp.ClientSession(loop=loop)
+    try:
+        for path in ('/', '/api/blogs', '/blog/%s' % blogs[0].id):
+            rps = await drive(session, 'http://%s:%s%s' % (HOST, PORT, path), n, concurrency)
+            print('%-36s %10.0f req/s' % ('GET %s' % path.replace(blogs[0].id, '{id}'), rps))
+    finally:
+        await session.close()
+
+if __name__ == '__main__':
+    logging.disable(logging.INFO)
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(bench(loop, n, concurrency))
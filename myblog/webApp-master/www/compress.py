@@ -0,0 +1,119 @@
+#coding:utf-8
+
+__author__ = 'Eric Lee'
+
+'''
+Response compression: gzip, and brotli when the brotli package is installed.
+
+coroweb 用它压缩动态响应；静态文件在打包时 (fab build) 用 python compress.py [目录] 预先压缩成
+.gz / .br，运行时直接发送，不再花 CPU。
+'''
+
+import os, sys, gzip, logging
+
+try:
+    import brotli
+except ImportError:
+    brotli = None # 没装时只用 gzip
+
+COMPRESS_MIN_SIZE = 1024 # 小于这么多字节不压缩，和 nginx 的 gzip_min_length 一样
+# 动态响应每次都要压缩，取速度和压缩率的折中；静态文件只压缩一次，用最高压缩率
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+STATIC_GZIP_LEVEL = 9
+STATIC_BROTLI_QUALITY = 11
+
+# 按优先顺序
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+SUFFIXES = dict(br='.br', gzip='.gz')
+
+_TYPES = frozenset(('application/json', 'application/javascript', 'application/x-javascript', 'application/xml',
+                    'image/svg+xml', 'application/vnd.ms-fontobject', 'font/ttf', 'font/otf'))
+STATIC_EXTENSIONS = frozenset(('.html', '.css', '.js', '.json', '.txt', '.xml', '.svg', '.eot', '.ttf', '.otf'))
+
+def compressible(content_type):
+    '''
+    >>> compressible('text/html; charset=utf-8'), compressible('application/json'), compressible('image/png')
+    (True, True, False)
+    '''
+    ct = (content_type or '').split(';')[0].strip().lower()
+    return ct.startswith('text/') or ct in _TYPES
+
+def accepted(accept_encoding, encodings=ENCODINGS):
+    '''
+    Encodings of encodings that an Accept-Encoding header accepts, best first.
+    >>> accepted('gzip, deflate, br', ('br', 'gzip'))
+    ['br', 'gzip']
+    >>> accepted('gzip;q=1.0, br;q=0.5', ('br', 'gzip'))
+    ['gzip', 'br']
+    >>> accepted('identity, *;q=0', ('br', 'gzip'))
+    []
+    '''
+    if not accept_encoding:
+        return []
+    q = dict()
+    for part in accept_encoding.split(','):
+        name, _, params = part.partition(';')
+        value = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                value = float(params[2:])
+            except ValueError:
+                value = 0.0
+        q[name.strip().lower()] = value
+    L = [(q.get(e, q.get('*', 0.0)), -i, e) for i, e in enumerate(encodings)]
+    return [e for value, i, e in sorted(L, reverse=True) if value > 0]
+
+def negotiate(accept_encoding):
+    '''
+    Best of ENCODINGS for an Accept-Encoding header, or None.
+    '''
+    L = accepted(accept_encoding)
+    return L[0] if L else None
+
+def compress(data, encoding, static=False):
+    if encoding == 'br':
+        return brotli.compress(data, quality=STATIC_BROTLI_QUALITY if static else BROTLI_QUALITY)
+    # mtime=0：同样的内容压缩出同样的字节
+    return gzip.compress(data, STATIC_GZIP_LEVEL if static else GZIP_LEVEL, mtime=0)
+
+def precompress(root, min_size=COMPRESS_MIN_SIZE):
+    '''
+    Write .gz (and .br) next to every file of root with a STATIC_EXTENSIONS extension and at least
+    min_size bytes, if it comes out smaller. Variants newer than their file are kept. Return the paths written.
+    '''
+    written = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in sorted(filenames):
+            if os.path.splitext(name)[1].lower() not in STATIC_EXTENSIONS:
+                continue
+            path = os.path.join(dirpath, name)
+            st = os.stat(path)
+            if st.st_size < min_size:
+                continue
+            data = None
+            for encoding in ENCODINGS:
+                target = path + SUFFIXES[encoding]
+                if os.path.exists(target) and os.stat(target).st_mtime >= st.st_mtime:
+                    continue
+                if data is None:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                out = compress(data, encoding, static=True)
+                if len(out) >= len(data):
+                    # 压缩了反而更大：不要变体，旧的也删掉
+                    if os.path.exists(target):
+                        os.remove(target)
+                    continue
+                with open(target, 'wb') as f:
+                    f.write(out)
+                written.append(target)
+    return written
+
+if __name__ == '__main__':
+    root = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    if brotli is None:
+        logging.warning('brotli is not installed, only .gz variants are written')
+    for path in precompress(root):
+        print(path)
@@ -5,11 +5,19 @@ Default configurations.
 configs = {
     'debug': True,
     'db': {
+        # 'mysql' 或 'sqlite'；sqlite 时用 'database' (默认 ':memory:') 和 'schema' (默认 sql.sql)
+        'engine': 'mysql',
         'host': "127.0.0.1",
         "port": 3306,
         "user": "root",
         "password": "root",
-        "db": 'awesome'
+        "db": 'awesome',
+        # 只读副本，例如 [{'host': '127.0.0.1', 'port': 3307}]，没写的项沿用主库配置
+        "replicas": []
+    },
+    # 主键生成器的 worker 编号 (1-1023)：多台机器时每个进程配置不同的编号；None 时用锁文件在本机自动申请
+    "ids": {
+        "worker": None
     },
     "session": {
         "secret": 'eric'
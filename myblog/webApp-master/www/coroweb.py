@@ -2,17 +2,99 @@
 
 __author__ = 'Eric Lee'
 
-import os, inspect
+import os, time, inspect, json, hashlib, mimetypes, collections
+from email.utils import formatdate, parsedate_to_datetime
 import logging; logging.basicConfig(level=logging.INFO)
 import functools, asyncio
+from concurrent.futures import ThreadPoolExecutor
 from urllib import parse
 from aiohttp import web
-from apis import APIError
+from apis import APIError, json_default
+import compress
 import types
 
-def get(path):
+try:
+    import orjson
+except ImportError:
+    orjson = None # 没装时用标准库 json
+
+# ---------------------- 兼容 @asyncio.coroutine / yield from 写的处理函数 ----------------------
+# 框架本身都是原生的 async def。Python 3.11 去掉了 asyncio.coroutine，这里补上一个同样行为的：
+# 生成器函数标记成可以 await 的 (types.coroutine)；普通函数包一层，返回值可以 await 时等待它
+def coroutine(func):
+    if inspect.isgeneratorfunction(func):
+        return types.coroutine(func)
+    if inspect.iscoroutinefunction(func):
+        return func
+    @functools.wraps(func)
+    def coro(*args, **kw):
+        r = func(*args, **kw)
+        if inspect.isgenerator(r) or inspect.iscoroutine(r):
+            r = yield from r
+        elif inspect.isawaitable(r):
+            r = yield from r.__await__()
+        return r
+    return types.coroutine(coro)
+
+if not hasattr(asyncio, 'coroutine'):
+    asyncio.coroutine = coroutine
+
+# ------------------------------------ JSON ------------------------------------
+# 处理函数返回的 dict 编码成 utf-8 的 JSON。json 不认识的对象按类型查 register_json() 注册的编码函数
+# (沿 MRO 查找，按类型缓存)，都没有时用 apis.json_default。装了 orjson (C 实现) 就用它，
+# 顶层的列表加起来很长时放到线程池里编码，不卡住事件循环
+JSON_THREAD_ITEMS = 1000
+JSON_THREADS = 2
+
+_json_encoders = dict()
+_json_executor = None
+
+def register_json(cls, encoder):
+    '''
+    Encode instances of cls and its subclasses as encoder(obj), which must return something JSON can encode.
+    '''
+    _json_encoders[cls] = encoder
+    _json_encoder.cache_clear()
+
+@functools.lru_cache(maxsize=256)
+def _json_encoder(t):
+    for c in t.__mro__:
+        if c in _json_encoders:
+            return _json_encoders[c]
+    return json_default
+
+def _json_default(o):
+    return _json_encoder(type(o))(o)
+
+def dumps(obj):
     '''
-    define decorator @get(/path)
+    Encode obj as utf-8 JSON bytes.
+    '''
+    if orjson is not None:
+        return orjson.dumps(obj, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, default=_json_default).encode('utf-8')
+
+def _json_items(obj):
+    if isinstance(obj, (list, tuple)):
+        return len(obj)
+    if isinstance(obj, dict):
+        return sum(len(v) for v in obj.values() if isinstance(v, (list, tuple)))
+    return 0
+
+async def dumps_async(obj):
+    '''
+    dumps() in a worker thread when the top-level lists of obj hold JSON_THREAD_ITEMS items or more.
+    '''
+    global _json_executor
+    if _json_items(obj) < JSON_THREAD_ITEMS:
+        return dumps(obj)
+    if _json_executor is None:
+        _json_executor = ThreadPoolExecutor(JSON_THREADS, thread_name_prefix='json')
+    return await asyncio.get_event_loop().run_in_executor(_json_executor, dumps, obj)
+
+def get(path, cache=None):
+    '''
+    define decorator @get(/path), cache: CachePolicy of the responses
     '''
     def decorator(func):
         @functools.wraps(func)
@@ -28,6 +110,7 @@ def get(path):
         '''
         wrapper.__method__ = 'GET'
         wrapper.__route__ = path
+        wrapper.__cache__ = cache
         return wrapper
     return decorator
 
@@ -41,6 +124,260 @@ def post(path):
         return wrapper
     return decorator
 
+# ------------------------------------ 响应缓存 ------------------------------------
+# 对所有匿名访客都一样的 GET 页面，把最终的响应 (状态、头、body) 缓存起来，不再运行处理函数和模板
+RESPONSE_CACHE_SIZE = 512
+# 这些头每次都不一样，或者不能给别人
+_UNCACHED_HEADERS = frozenset(('content-length', 'date', 'set-cookie'))
+
+class CachePolicy(object):
+    '''
+    Response caching of a GET route: @get(path, cache=CachePolicy(ttl=10, vary=['user'], tables=[Blog])).
+    Responses are keyed by path, query string and the vary inputs: 'user' for the signed in user,
+    any other name is a request header. An entry expires after ttl seconds, or as soon as one of
+    tables (models or table names) is written.
+    '''
+    def __init__(self, ttl=60, vary=(), tables=()):
+        self.ttl = ttl
+        self.vary = tuple(vary)
+        self.tables = tuple(getattr(t, '__table__', t) for t in tables)
+
+def _vary_value(request, name):
+    if name == 'user':
+        user = getattr(request, '__user__', None)
+        return user.id if user else None
+    return request.headers.get(name)
+
+class ResponseCache(object):
+    '''
+    LRU cache of finished responses of routes with a CachePolicy. version(tables) is part of the key:
+    it must change when one of tables is written, old entries are then never hit again.
+    Requests for a key being computed wait for that response (single-flight).
+    '''
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, version=None):
+        self.maxsize = maxsize
+        self.version = version or (lambda tables: ())
+        self._data = collections.OrderedDict() # key -> (expires, status, headers, body)
+        self._inflight = dict() # key -> future
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.evictions = 0
+
+    def _key(self, request, policy):
+        vary = tuple(_vary_value(request, name) for name in policy.vary)
+        # 缓存的是压缩过的 body，按协商出来的编码分开
+        encoding = compress.negotiate(request.headers.get('Accept-Encoding'))
+        return (request.path, request.query_string, vary, encoding, self.version(policy.tables))
+
+    def _entry(self, r, ttl):
+        if not isinstance(r, web.Response) or r.status != 200 or not isinstance(r.body, bytes):
+            return None
+        # set_cookie() 的 cookie 在发送前才写进头里
+        if r.cookies or 'Set-Cookie' in r.headers:
+            return None
+        headers = tuple((k, v) for k, v in r.headers.items() if k.lower() not in _UNCACHED_HEADERS)
+        return (time.time() + ttl, r.status, headers, r.body)
+
+    def _response(self, item):
+        expires, status, headers, body = item
+        r = web.Response(status=status, headers=headers, body=body)
+        r.headers['X-Cache'] = 'hit'
+        return r
+
+    async def respond(self, request, policy, handler):
+        key = self._key(request, policy)
+        item = self._data.get(key)
+        if item is not None and item[0] >= time.time():
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._response(item)
+        fut = self._inflight.get(key)
+        if fut is not None:
+            # 同一个 key 已经在生成：等它的结果；它不能缓存时再自己处理
+            self.waits += 1
+            item = await asyncio.shield(fut)
+            if item is not None:
+                return self._response(item)
+            return await handler(request)
+        self.misses += 1
+        fut = self._inflight[key] = asyncio.get_event_loop().create_future()
+        item = None
+        try:
+            r = await handler(request)
+            item = self._entry(r, policy.ttl)
+            if item is not None:
+                self._data[key] = item
+                self._data.move_to_end(key)
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+                    self.evictions += 1
+            return r
+        finally:
+            del self._inflight[key]
+            fut.set_result(item)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return dict(size=len(self._data), maxsize=self.maxsize, hits=self.hits, misses=self.misses,
+                    waits=self.waits, evictions=self.evictions)
+
+response_cache = ResponseCache()
+
+# ------------------------------------ 条件 GET ------------------------------------
+# GET 的 200 响应都带上 ETag：处理函数用 not_modified() 给了版本就用它，否则是 body 的哈希。
+# 客户端的 If-None-Match / If-Modified-Since 对得上时回 304，不再发送 body
+# 进程重启后表的写入版本从头算，version_etag() 里带上这个进程的标记
+_PROCESS_TAG = os.urandom(4).hex()
+VERSION_ETAG_TTL = 60
+
+def body_etag(body):
+    return '"%s"' % hashlib.md5(body).hexdigest()
+
+def version_etag(tables, *parts, ttl=VERSION_ETAG_TTL):
+    '''
+    ETag from the write version of tables (see ResponseCache.version), parts and a ttl-second time bucket,
+    for not_modified(). The version only counts writes made by this process: writes by other worker
+    processes or by scripts such as ids.py are not seen, so a client may get 304 for stale content
+    until the bucket changes, at most ttl seconds, the same bound as the response cache.
+    '''
+    version = response_cache.version(tuple(getattr(t, '__table__', t) for t in tables))
+    bucket = int(time.time() // ttl)
+    return '"%s-%s-%s"' % (_PROCESS_TAG, bucket, '-'.join(str(v) for v in version + parts))
+
+def not_modified(request, etag=None, last_modified=None):
+    '''
+    For handlers that know the version of their response before querying or rendering: True if the
+    client already has it (the handler then returns web.HTTPNotModified()). Otherwise the response
+    gets etag / last_modified (a timestamp) instead of a hash of its body.
+    '''
+    request.__validators__ = (etag, last_modified)
+    return _fresh(request, etag, last_modified)
+
+# 弱比较：nginx gzip 之后把强 ETag 改成了 W/"..."
+def _opaque(tag):
+    return tag[2:] if tag.startswith('W/') else tag
+
+def _fresh(request, etag, last_modified):
+    tags = request.headers.get('If-None-Match')
+    if tags is not None:
+        # 有 If-None-Match 时忽略 If-Modified-Since
+        if etag is None:
+            return False
+        tags = [_opaque(t.strip()) for t in tags.split(',')]
+        return '*' in tags or _opaque(etag) in tags
+    since = request.headers.get('If-Modified-Since')
+    if since is None or last_modified is None:
+        return False
+    try:
+        return int(last_modified) <= parsedate_to_datetime(since).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+def add_validators(request, r):
+    '''
+    Set ETag / Last-Modified of a 200 GET response with a body, see not_modified().
+    '''
+    if request.method != 'GET' or not isinstance(r, web.Response) or r.status != 200 or not isinstance(r.body, bytes):
+        return r
+    etag, last_modified = getattr(request, '__validators__', (None, None))
+    if etag is None and 'ETag' not in r.headers:
+        etag = body_etag(r.body)
+    if etag is not None:
+        r.headers['ETag'] = etag
+    if last_modified is not None:
+        r.headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+    return r
+
+def conditional(request, r):
+    '''
+    web.HTTPNotModified() with the validators of r when the client's copy is fresh, else r.
+    '''
+    if request.method != 'GET' or not isinstance(r, web.StreamResponse):
+        return r
+    if r.status == 304:
+        # 处理函数根据 not_modified() 直接返回的
+        etag, last_modified = getattr(request, '__validators__', (None, None))
+        if etag is not None:
+            r.headers['ETag'] = etag
+        return r
+    if r.status != 200 or r.cookies:
+        return r
+    etag = r.headers.get('ETag')
+    last_modified = r.headers.get('Last-Modified')
+    if last_modified is not None:
+        last_modified = parsedate_to_datetime(last_modified).timestamp()
+    if not _fresh(request, etag, last_modified):
+        return r
+    headers = dict((k, r.headers[k]) for k in ('ETag', 'Last-Modified', 'Cache-Control') if k in r.headers)
+    return web.HTTPNotModified(headers=headers)
+
+def route_cache(request):
+    '''
+    CachePolicy of the route matched by request, or None.
+    '''
+    handler = inspect.unwrap(request.match_info.handler)
+    return getattr(handler, '_cache', None)
+
+# ------------------------------------ 压缩 ------------------------------------
+def _add_vary(r, name):
+    vary = r.headers.get('Vary')
+    if not vary:
+        r.headers['Vary'] = name
+    elif name.lower() not in [v.strip().lower() for v in vary.split(',')]:
+        r.headers['Vary'] = '%s, %s' % (vary, name)
+
+def compress_response(request, r):
+    '''
+    Compress the body of r with the best encoding the client accepts, when the content type
+    is compressible and the body has at least compress.COMPRESS_MIN_SIZE bytes.
+    '''
+    if not isinstance(r, web.Response) or not isinstance(r.body, bytes) or len(r.body) < compress.COMPRESS_MIN_SIZE:
+        return r
+    if 'Content-Encoding' in r.headers or not compress.compressible(r.headers.get('Content-Type')):
+        return r
+    _add_vary(r, 'Accept-Encoding')
+    encoding = compress.negotiate(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return r
+    r.body = compress.compress(r.body, encoding)
+    r.headers['Content-Encoding'] = encoding
+    # 压缩后的字节不一样了，ETag 改成弱的 (nginx 的 gzip 也是这样)
+    etag = r.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        r.headers['ETag'] = 'W/' + etag
+    return r
+
+class StaticFiles(object):
+    '''
+    GET/HEAD /static/{filename}: files under root. When the client accepts it, the .br / .gz variant
+    written by compress.py is sent instead, as long as it is not older than the file.
+    '''
+    def __init__(self, root):
+        self._root = os.path.realpath(root)
+
+    async def __call__(self, request):
+        path = os.path.realpath(os.path.join(self._root, request.match_info['filename']))
+        if not path.startswith(self._root + os.sep) or not os.path.isfile(path):
+            return web.HTTPNotFound()
+        ct, encoding = mimetypes.guess_type(path)
+        headers = {'Content-Type': ct or 'application/octet-stream', 'Vary': 'Accept-Encoding'}
+        serve = path
+        # 变体可能是在别的机器上打包时生成的，这里没装 brotli 也可以发送 .br
+        mtime = os.stat(path).st_mtime
+        for encoding in compress.accepted(request.headers.get('Accept-Encoding'), tuple(compress.SUFFIXES)):
+            variant = path + compress.SUFFIXES[encoding]
+            try:
+                if os.stat(variant).st_mtime >= mtime:
+                    serve = variant
+                    headers['Content-Encoding'] = encoding
+                    break
+            except OSError:
+                continue
+        return web.FileResponse(serve, headers=headers)
+
 # --- 使用inspect模块中的signature方法来获取函数的参数，实现一些复用功能--
 # inspect.Parameter 的类型有5种：
 # POSITIONAL_ONLY		只能是位置参数
@@ -97,87 +434,139 @@ def has_requset_arg(fn):
             raise ValueError('request paramter must be the last named parameter in function %s %s'%(fn.__name__, str(sig)))
     return found
 
+# ------------------------------------ 参数绑定 ------------------------------------
+# 处理函数的签名在注册路由时只分析一次，编译成 bind(request, params)，只包含这个函数用得到的步骤：
+# 过滤出命名关键字参数、合并 match_info、传入 request、检查必填参数、按类型转换。
+# params 是解析出来的 JSON / 表单 / 查询参数，没有时为 None
+class _BadRequest(Exception):
+    pass
+
+def _bool(v):
+    if isinstance(v, bool):
+        return v
+    return str(v).lower() in ('1', 'true', 'yes', 'on')
+
+# 参数的注解 (page: int = 1) 或者默认值是 int/float/bool 时，把请求里的字符串转换成这个类型；
+# 转换不了时原样传给处理函数，由它决定怎么处理 (比如 get_page_index() 回到第 1 页)
+def _coercer(param):
+    t = param.annotation
+    if t is inspect.Parameter.empty and param.default not in (inspect.Parameter.empty, None):
+        t = type(param.default)
+    if t is bool:
+        return _bool
+    if t in (int, float):
+        return t
+    return None
+
+def _compile_function(name, params, body, namespace):
+    src = 'def %s(%s):\n    %s\n' % (name, params, '\n    '.join(body))
+    exec(compile(src, '<coroweb %s>' % name, 'exec'), namespace)
+    return namespace[name]
+
+def _compile_binder(fn):
+    params = inspect.signature(fn).parameters
+    has_var_kw = has_var_kw_arg(fn)
+    named = get_named_kw_args(fn)
+    ns = dict(BadRequest=_BadRequest, log=logging.info)
+    body = []
+    if has_var_kw or named:
+        body.extend(['if params is None:', '    kw = dict(request.match_info)', 'else:'])
+        if has_var_kw:
+            body.append('    kw = params')
+        else:
+            # 没有 **kw 时只保留命名关键字参数
+            ns['keep'] = frozenset(named)
+            body.append('    kw = {k: v for k, v in params.items() if k in keep}')
+        body.extend(['    for k, v in request.match_info.items():',
+                     '        if k in kw:',
+                     "            log('Duplicate arg name in named arg and kw args: %s' % k)",
+                     '        kw[k] = v'])
+    else:
+        # 没有关键字参数，只从 match_info 取
+        body.append('kw = dict(request.match_info)')
+    if has_requset_arg(fn):
+        body.append("kw['request'] = request")
+    for name in get_required_kw_args(fn):
+        body.extend(['if %r not in kw:' % name, '    raise BadRequest(%r)' % ('Missing argument: %s' % name)])
+    for name in named:
+        coerce = _coercer(params[name])
+        if coerce is None:
+            continue
+        ns['coerce_%s' % name] = coerce
+        body.extend(['if %r in kw:' % name,
+                     '    try:',
+                     '        kw[%r] = coerce_%s(kw[%r])' % (name, name, name),
+                     '    except (TypeError, ValueError):',
+                     '        pass'])
+    body.append('return kw')
+    return _compile_function('bind_%s' % fn.__name__, 'request, params', body, ns)
+
+async def _read_body(request):
+    if not request.content_type:
+        raise _BadRequest('Missing Content-Type')
+    ct = request.content_type.lower()
+    if ct.startswith('application/json'):
+        params = await request.json() #从json数组获取参数
+        if not isinstance(params, dict):
+            raise _BadRequest('JSON body must be object')
+        return params
+    if ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+        params = await request.post() # k-v?
+        return dict(**params)
+    raise _BadRequest('Unsupported Content-Type: %s' % request.content_type)
+
+def _read_query(qs):
+    if not qs:
+        return None
+    # get url ?后面的键值对，同名的取第一个：'first=f,s&second=s' -> {'first': 'f,s', 'second': 's'}
+    kw = dict()
+    for k, v in parse.parse_qsl(qs, True):
+        kw.setdefault(k, v)
+    return kw
+
 # RequestHandler目的就是从URL处理函数（如handlers.index）中分析其需要接收的参数，然后从web.request对象中获取必要的参数，
 # 在后面调用URL处理函数就可以进入这里，然后把结果转换为web.Response对象，这样，就完全符合aiohttp框架的要求
 class RequestHandler(object):
     # app, 框架的主函数
     # fn: url 处理函数
     def __init__(self, app, fn):
+        self._cache = getattr(fn, '__cache__', None)
+        # @get/@post 的 wrapper 只是转调，跳过它们直接调用被装饰的函数；
+        # 它们下面的其他装饰器 (鉴权、审计等) 不能跳过，这种 wrapper 可能返回生成器，也要包成可以 await
+        fn = inspect.unwrap(fn, stop=lambda f: not hasattr(f, '__route__'))
+        if hasattr(fn, '__wrapped__') and not inspect.iscoroutinefunction(fn):
+            # 最里面的生成器函数就地标记 (types.coroutine 改的是 __code__)，wrapper 调用它时才能 yield from 协程
+            coroutine(inspect.unwrap(fn))
+            fn = coroutine(fn)
+        elif inspect.isgeneratorfunction(fn):
+            fn = coroutine(fn)
         self._app = app
         self._func = fn
-        self._has_request_arg = has_requset_arg(fn)
-        self._has_var_kw_arg = has_var_kw_arg(fn)
-        self._has_named_kw_args = has_named_kw_args(fn)
-        self._named_kw_args = get_named_kw_args(fn)
-        self._required_kw_args = get_required_kw_args(fn)
-
-    # 1.定义kw对象，用于保存参数
-    # 2.判断URL处理函数是否存在参数，如果存在则根据是POST还是GET方法将request请求内容保存到kw
-    # 3.如果kw为空(说明request没有请求内容)，则将match_info列表里面的资源映射表赋值给kw；如果不为空则把命名关键字参数的内容fn（name=value）给kw
-    # 4.完善_has_request_arg和_required_kw_args属性
-    @asyncio.coroutine
-    def __call__(self, request):
-        kw = None
-        # 有 **kw / name=value / name=''
-        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
-            if request.method == 'POST': # wrapper._method_
-                if not request.content_type:
-                    return web.HTTPBadRequest('Missing Content-Type')
-                ct = request.content_type.lower()
-                if ct.startswith('application/json'):
-                    params = yield from request.json() #从json数组获取参数
-                    if not isinstance(params, dict):
-                        return web.HTTPBadRequest('JSON body must be object')
-                    kw = params
-                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
-                    params = yield from request.post() # k-v?
-                    kw = dict(**params)
-                else:
-                    return web.HTTPBadRequest('Unsupported Content-Type: %s'%request.content_type)
-            if request.method == 'GET':
-                qs = request.query_string
-                if qs:
-                    kw = dict()
-                    # get url ?后面的键值对
-                    '''
-                    qs = 'first=f,s&second=s'
-                    parse.parse_qs(qs,True).items()
-                    >>> dict([('first', ['f,s',]),('second', ['s',])])
-                    '''
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kw[k] = v[0] # v : ['f,s',]
-        if kw is None:
-            # request为空或者 url处理函数没有参数，直接从 match_info 获取
-            '''
-            def hello(request):
-                text = '<h1>hello, %s!</h1>' % request.match_info['name']
-                return web.Response()
-            app.router.add_route('GET', '/hello/{name}', hello)
-           '''
-            kw = dict(**request.match_info)
-        else:
-            # 没有 **kw 参数只有 k=v
-            if not self._has_var_kw_arg and self._named_kw_args:
-                copy = dict()
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name] #保持已有的值
-                kw = copy
-            for k, v in request.match_info.items():
-                if k in kw: # check named arg: 检查关键字参数的名字是否和match_info中的重复
-                    logging.info('Duplicate arg name in named arg and kw args: %s' % k)
-                kw[k] = v
-        if self._has_request_arg:
-            kw['request'] = request #把 request 传进fn, 可能为空
-
-        #检查是否有关键字参数并且放进了kw。且初始值为empty
-        if self._required_kw_args:
-            for name in self._required_kw_args:
-                if not name in kw:
-                    return web.HTTPBadRequest('Missing argument: %s '% name)
-        logging.info('Call with args : %s'% str(kw))
+        # 原生协程和生成器协程都要 await，普通函数直接调用
+        self._is_coroutine = inspect.iscoroutinefunction(fn) or inspect.isgeneratorfunction(fn)
+        # 有 **kw 或者命名关键字参数时才需要解析请求体 / 查询参数
+        self._parse = bool(has_var_kw_arg(fn) or has_named_kw_args(fn))
+        self._bind = _compile_binder(fn)
+
+    async def __call__(self, request):
+        try:
+            params = None
+            if self._parse:
+                if request.method == 'POST':
+                    params = await _read_body(request)
+                elif request.method == 'GET':
+                    params = _read_query(request.query_string)
+            kw = self._bind(request, params)
+        except _BadRequest as e:
+            return web.HTTPBadRequest(text=str(e))
+        if logging.root.isEnabledFor(logging.INFO):
+            logging.info('Call with args : %s' % str(kw))
         try:
-            r = yield from self._func(**kw)
+            if self._is_coroutine:
+                return await self._func(**kw)
+            r = self._func(**kw)
+            if inspect.isawaitable(r):
+                r = await r
             return r
         except APIError as e:
             return dict(error=e.error, data=e.data, message=e.message)
@@ -186,7 +575,10 @@ class RequestHandler(object):
 # static目录与本文件在同一级别目录下
 def add_static(app):
     path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
-    app.router.add_static('/static/', path)
+    static = StaticFiles(path)
+    # HEAD 也要能访问；FileResponse 对 HEAD 只发头
+    for method in ('GET', 'HEAD'):
+        app.router.add_route(method, '/static/{filename:.+}', static)
     logging.info('add static %s => %s' % ('/static/', path))
 
 # 注册fn 成为真正的url处理函数 传递访问方法和路径进去
@@ -195,8 +587,6 @@ def add_route(app, fn):
     path = getattr(fn, '__route__', None)
     if path is None or method is None:
         raise ValueError('@get or @post not defined in %s.' % str(fn))
-    if not asyncio.iscoroutinefunction(fn)  and not inspect.isgeneratorfunction(fn):
-        fn = asyncio.coroutine(fn)
     logging.info('add route %s %s => %s(%s)' % (method, path, fn.__name__, ','.join(inspect.signature(fn).parameters.keys())))
     # 第三个参数是个函数，__call__()，类实例
     app.router.add_route(method, path, RequestHandler(app, fn))
@@ -1,14 +1,16 @@
 # -*- coding:utf-8 -*-
 import re
 import time
-import json
 import logging; logging.basicConfig(level=logging.INFO)
 import hashlib
 import markdown2
 import asyncio
-from apis import APIValueError, APIResourceNotFoundError, APIError, APIPermissionError ,Page
+from apis import APIValueError, APIResourceNotFoundError, APIError, APIPermissionError ,Page, decode_cursor
+import orm
+import indexes
+from orm import KEYSET_ORDER_BY
 from aiohttp import web
-from coroweb import get, post
+from coroweb import get, post, dumps, CachePolicy, response_cache, not_modified, version_etag
 from models import User, Blog, Comment, next_id
 from config import configs
 
@@ -98,7 +100,10 @@ def handler_url_result(*, user_email, request):
     return response
 
 
-@get('/')
+# 匿名访客看到的都一样的页面缓存这么多秒，博客或评论有写入时立即失效
+PAGE_CACHE_TTL = 30
+
+@get('/', cache=CachePolicy(ttl=PAGE_CACHE_TTL, vary=['user'], tables=[Blog, Comment]))
 @asyncio.coroutine
 def index(*, page='1'):
     # summary = "Try something new," \
@@ -114,7 +119,7 @@ def index(*, page='1'):
 
     page_index = get_page_index(page)
     # 查找博客表里的条目数
-    num = yield from Blog.findNumber('count(id)')
+    num = yield from Blog.count()
     # 没有条目则不显示
     if not num or num == 0:
         logging.info('the type of num is :%s' % type(num))
@@ -123,7 +128,7 @@ def index(*, page='1'):
         page = Page(num, page_index)
         # 根据计算出来的offset(取的初始条目index)和limit(取的条数)，来取出条目
         # 首页只显示前5篇文章
-        blogs = yield from Blog.findAll(orderBy='created_at desc', limit=(0, 5))
+        blogs = yield from Blog.findAll(orderBy='created_at desc', limit=(0, 5), columns=Blog.summary_view, cache=True, preload_counts=['comments'])
     return {
         '__template__': 'blogs.html',
         'page': page,
@@ -167,7 +172,7 @@ def api_register_user(*, email, name, passwd):
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.passwd = '********' # 同一显示
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = dumps(user)
     return r
 
 
@@ -208,7 +213,7 @@ def authenticate(*, email, passwd):
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.passwd = "********"
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = dumps(user)
     return r # 给 request
 
 
@@ -236,18 +241,23 @@ def show_all_users():
 
 @get('/api/users')
 @asyncio.coroutine
-def api_get_users(*, page='1'):
+def api_get_users(*, page=1, cursor=None):
     logging.info('Api users is here!')
     page_index = get_page_index(page)
     # count为MySQL中的聚集函数，用于计算某列的行数
     # user_count代表了有多个用户id
-    user_count = yield from User.findNumber('count(id)')
+    user_count = yield from User.count()
     p = Page(user_count, page_index)
     # 通过Page类来计算当前页的相关信息, 其实是数据库limit语句中的offset，limit
     if user_count == 0:
         return dict(page=p, users=())
     # page.offset表示从那一行开始检索，page.limit表示检索多少行
-    users = yield from User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    # 有 cursor 时从上一页最后一条之后取，深翻页和第一页的代价一样
+    if cursor:
+        users = yield from User.findAll(after=decode_cursor(cursor), limit=p.page_size)
+    else:
+        users = yield from User.findAll(orderBy=KEYSET_ORDER_BY, limit=(p.offset, p.limit))
+    p.set_cursor(users, after=bool(cursor))
 
     for u in users:
         u.passwd = '*******'
@@ -297,15 +307,23 @@ def api_create_blog(request, *, name, summary, content):
     return blog
 
 
-@get('/api/blogs')
+@get('/api/blogs', cache=CachePolicy(ttl=PAGE_CACHE_TTL, tables=[Blog, Comment]))
 @asyncio.coroutine
-def api_blogs(*, page='1'):
+def api_blogs(request, *, page=1, cursor=None):
+    # 博客和评论都没有写入时，客户端手里的就是最新的，不用查库；
+    # 只看得到本进程的写入，别的进程写了之后最多 PAGE_CACHE_TTL 秒内还会回 304
+    if not_modified(request, version_etag([Blog, Comment], request.query_string, ttl=PAGE_CACHE_TTL)):
+        return web.HTTPNotModified()
     page_index = get_page_index(page)
-    blogs_count = yield from Blog.findNumber('count(id)')
+    blogs_count = yield from Blog.count()
     p = Page(blogs_count, page_index)
     if blogs_count == 0:
         return dict(page=p, blogs=())
-    blogs = yield from Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    if cursor:
+        blogs = yield from Blog.findAll(after=decode_cursor(cursor), limit=p.page_size, columns=Blog.summary_view, cache=True, preload_counts=['comments'])
+    else:
+        blogs = yield from Blog.findAll(orderBy=KEYSET_ORDER_BY, limit=(p.offset, p.limit), columns=Blog.summary_view, cache=True, preload_counts=['comments'])
+    p.set_cursor(blogs, after=bool(cursor))
     return dict(page=p, blogs=blogs)
 
 
@@ -324,9 +342,11 @@ def get_blog(id):
     }
 
 
-@get('/api/blogs/{id}')
+@get('/api/blogs/{id}', cache=CachePolicy(ttl=PAGE_CACHE_TTL, tables=[Blog]))
 @asyncio.coroutine
-def api_get_blog(*, id):
+def api_get_blog(request, *, id):
+    if not_modified(request, version_etag([Blog], id, ttl=PAGE_CACHE_TTL)):
+        return web.HTTPNotModified()
     blog = yield from Blog.find(id)
     return blog
 
@@ -339,10 +359,18 @@ def api_delete_blog(id, request):
     b = yield from Blog.find(id)
     if b is None:
         raise APIResourceNotFoundError('Blog')
-        yield from b.remove()
+    # 博客和它的评论在同一个事务里删除
+    yield from orm.transaction().run(_remove_blog, b)
     return dict(id=id)
 
 
+@asyncio.coroutine
+def _remove_blog(blog):
+    yield from blog.remove()
+    n = yield from orm.execute('delete from `comments` where `blog_id`=?', [blog.id])
+    yield from orm.add_counters([(Comment.counter(), -n), (Comment.counter(blog_id=blog.id), -n)])
+
+
 @post('/api/blogs/modify')
 @asyncio.coroutine
 def api_modify_blog(request, *, id, name, summary, content):
@@ -391,13 +419,17 @@ def manage_commets(*, page='1'):
 
 @get('/api/comments')
 @asyncio.coroutine
-def api_comments(*, page='1'):
+def api_comments(*, page=1, cursor=None):
     page_index = get_page_index(page)
-    num = yield from Comment.findNumber('count(id)')
+    num = yield from Comment.count()
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, comments=())
-    comments = yield from Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    if cursor:
+        comments = yield from Comment.findAll(after=decode_cursor(cursor), limit=p.page_size)
+    else:
+        comments = yield from Comment.findAll(orderBy=KEYSET_ORDER_BY, limit=(p.offset, p.limit))
+    p.set_cursor(comments, after=bool(cursor))
     return dict(page=p, comments=comments)
 
 
@@ -430,19 +462,12 @@ def api_delete_comments(id, request):
     return dict(id=id)
 
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+# ----------------------------------------运行指标-----------------------------------------
+@get('/api/metrics')
+def api_metrics(request, *, format='json'):
+    check_admin(request)
+    if format == 'text':
+        r = web.Response(body=orm.dump_metrics().encode('utf-8'))
+        r.content_type = 'text/plain;charset=utf-8'
+        return r
+    return dict(orm.metrics(), unindexed=indexes.unindexed_queries(), response_cache=response_cache.stats())
@@ -0,0 +1,191 @@
+#coding:utf-8
+
+__author__ = 'Eric Lee'
+
+'''
+Time-ordered compact primary keys.
+
+一个 id 是 63 位整数：41 位毫秒时间戳 (从 EPOCH_MS 起) + 10 位 worker + 12 位序号，
+用 32 个字符 (按 ASCII 递增) 编码成定长 13 位字符串，字符串的顺序就是生成的时间顺序，
+旧的 next_id() ('%015d' 毫秒 + uuid) 都排在新 id 前面。
+
+python ids.py migrate 把 blogs/comments 的旧 id 换成新 id (按 created_at)，校正计数器，并输出收窄列的 DDL。
+迁移时要先停掉应用：运行中的进程的查询缓存、响应缓存里还是旧 id。
+'''
+
+import os, time, logging, tempfile, threading, asyncio
+
+import orm
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # windows
+
+EPOCH_MS = 1420070400000 # 2015-01-01 UTC
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+ALPHABET = '0123456789abcdefghjkmnpqrstvwxyz' # crockford base32，小写，MySQL 不区分大小写的排序规则下也不会冲突
+ID_LENGTH = 13
+
+# 迁移旧数据用 worker 0，运行中的进程从 1 开始申请
+MIGRATION_WORKER = 0
+
+def encode(n):
+    '''
+    >>> encode(0), encode(31), encode(32)
+    ('0000000000000', '000000000000z', '0000000000010')
+    '''
+    chars = []
+    for i in range(ID_LENGTH):
+        chars.append(ALPHABET[n & 31])
+        n >>= 5
+    return ''.join(reversed(chars))
+
+def make_id(ms, worker, sequence):
+    '''
+    >>> make_id(EPOCH_MS + 1, 1, 0) < make_id(EPOCH_MS + 1, 1, 1) < make_id(EPOCH_MS + 2, 0, 0)
+    True
+    '''
+    return encode(((ms - EPOCH_MS) << (WORKER_BITS + SEQUENCE_BITS)) | (worker << SEQUENCE_BITS) | sequence)
+
+def id_time(id):
+    '''
+    Creation time (seconds) of an id from make_id().
+    '''
+    n = 0
+    for ch in id:
+        n = (n << 5) | ALPHABET.index(ch)
+    return ((n >> (WORKER_BITS + SEQUENCE_BITS)) + EPOCH_MS) / 1000.0
+
+class IdGenerator(object):
+    '''
+    Callable returning a new id. Each process needs its own worker number: pass worker= (configs.ids.worker)
+    when processes run on several hosts, otherwise a free one is claimed with a lock file in lock_dir.
+    Ids stay monotonic when the clock goes back or more than 4096 ids are made in one millisecond.
+    '''
+    def __init__(self, worker=None, lock_dir=None):
+        if worker is not None and not MIGRATION_WORKER < worker <= MAX_WORKER:
+            raise ValueError('Invalid worker: %s' % worker)
+        self._configured = worker
+        self._lock_dir = lock_dir or tempfile.gettempdir()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._lock_file = None
+        self.worker = None
+        self._last = 0
+        self._sequence = 0
+
+    def _claim(self):
+        # fork 出来的子进程要换一个 worker
+        self._pid = os.getpid()
+        self._last = 0
+        if self._configured is not None:
+            self.worker = self._configured
+            return
+        if fcntl is None:
+            self.worker = self._pid % MAX_WORKER + 1
+            logging.warning('no fcntl, id worker %s from pid may collide across processes' % self.worker)
+            return
+        for worker in range(MIGRATION_WORKER + 1, MAX_WORKER + 1):
+            # 别的用户留下的锁文件打不开 (PermissionError)，换下一个
+            try:
+                f = open(os.path.join(self._lock_dir, 'myblog-id-%d.lock' % worker), 'a')
+            except OSError:
+                continue
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                continue
+            # 进程退出时锁自动释放
+            self._lock_file = f
+            self.worker = worker
+            logging.info('claimed id worker %s' % worker)
+            return
+        raise RuntimeError('no free id worker in %s' % self._lock_dir)
+
+    def __call__(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._claim()
+            ms = int(time.time() * 1000)
+            if ms > self._last:
+                self._last, self._sequence = ms, 0
+            else:
+                # 同一毫秒内或者时钟回拨：沿用上一个时间戳，序号用完就借用下一毫秒
+                self._sequence += 1
+                if self._sequence > MAX_SEQUENCE:
+                    self._last, self._sequence = self._last + 1, 0
+            return make_id(self._last, self.worker, self._sequence)
+
+# ------------------------------------ 迁移旧 id ------------------------------------
+# users.id 不迁移：注册时密码存的是 sha1('<id>:<passwd>')，换 id 之后就登录不了了
+# (表, 外键列)：换掉表的主键时同时更新引用它的列
+MIGRATIONS = (
+    ('blogs', (('comments', 'blog_id'),)),
+    ('comments', ()),
+)
+
+async def _migrate_rows(table, refs, rows, sequence):
+    for r in rows:
+        ms = int(r['created_at'] * 1000)
+        sequence[ms] = sequence.get(ms, -1) + 1
+        new = make_id(ms, MIGRATION_WORKER, sequence[ms])
+        await orm.execute('update `%s` set `id`=? where `id`=?' % table, [new, r['id']])
+        for ref_table, column in refs:
+            await orm.execute('update `%s` set `%s`=? where `%s`=?' % (ref_table, column, column), [new, r['id']])
+
+async def migrate(batch_size=500):
+    '''
+    Give old rows of MIGRATIONS a time-ordered id made from their created_at. One transaction per batch,
+    rows already migrated are skipped, so it can be stopped and run again. Return {table: rows migrated}.
+    Stop the app first: running processes keep serving old ids from their caches.
+    '''
+    counts = dict()
+    for table, refs in MIGRATIONS:
+        sequence = dict() # 毫秒 -> 已用的序号
+        total = 0
+        first = True
+        while True:
+            rows = await orm.select('select `id`, `created_at` from `%s` where length(`id`)<>? order by `created_at`, `id` limit ?' % table,
+                                    [ID_LENGTH, batch_size])
+            if not rows:
+                break
+            if first:
+                # 上次中断时，最早的这一毫秒可能已经迁移了几行，序号接着用
+                first = False
+                ms = int(rows[0]['created_at'] * 1000)
+                rs = await orm.select('select count(`id`) _num_ from `%s` where `id` between ? and ?' % table,
+                                      [make_id(ms, MIGRATION_WORKER, 0), make_id(ms, MIGRATION_WORKER, MAX_SEQUENCE)], 1)
+                sequence[ms] = rs[0]['_num_'] - 1
+            await orm.transaction().run(_migrate_rows, table, refs, rows, sequence)
+            total += len(rows)
+        counts[table] = total
+    return counts
+
+def shrink_ddl():
+    return ['alter table `blogs` modify `id` varchar(16) not null;',
+            'alter table `comments` modify `id` varchar(16) not null, modify `blog_id` varchar(16) not null;']
+
+async def main(loop):
+    import models
+    from config import configs
+    await orm.create_pool(loop=loop, **configs.db)
+    for table, n in (await migrate()).items():
+        print('-- migrated %s rows of %s' % (n, table))
+    # 按父记录的计数器名字里有旧 id
+    await orm.reconcile_counters()
+    for ddl in shrink_ddl():
+        print(ddl)
+
+if __name__ == '__main__':
+    import sys
+    if sys.argv[1:] != ['migrate']:
+        print('usage: python ids.py migrate')
+        sys.exit(1)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop))
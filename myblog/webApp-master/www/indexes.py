@@ -0,0 +1,87 @@
+#coding:utf-8
+
+__author__ = 'Eric Lee'
+
+'''
+Index advisor: 对比模型声明的索引 (Field(index=...) / orm.Index) 和数据库里实际的索引，生成迁移 DDL；
+再看 orm 记录下来的查询形状，找出 where 条件没有索引可用的查询。
+
+python indexes.py 连接 configs.db，输出迁移 DDL。
+'''
+
+import re, asyncio, logging
+
+import orm
+
+_RE_SELECT = re.compile(r'^select .+? from `(\w+)`(?: where (.+?))?(?: order by .+?)?(?: limit [%s,]+)?$', re.S)
+_RE_WORD = re.compile(r'`?(\w+)`?')
+
+def declared():
+    '''
+    Declared indexes of all models: [(table, Index)].
+    '''
+    return [(table, index) for table, cls in sorted(orm._models.items()) for index in cls.__indexes__]
+
+async def existing():
+    '''
+    Indexes in the database except primary keys: [(table, Index)].
+    '''
+    async with orm._primary().acquire() as conn:
+        rs = await orm._backend.indexes(conn, sorted(orm._models))
+    return [(t, orm.Index(*columns, unique=unique, name=name)) for t, name, columns, unique in rs]
+
+def diff(want, have):
+    '''
+    Return (missing, extra): declared but not in database, and in database but not declared.
+    Indexes are compared by columns and uniqueness, names may differ.
+    '''
+    missing = [(t, i) for t, i in want if (t, i) not in have]
+    extra = [(t, i) for t, i in have if (t, i) not in want]
+    return missing, extra
+
+async def migration():
+    '''
+    DDL to bring the database indexes in line with the models. Undeclared indexes are
+    only listed as comments, dropping them is left to a human.
+    '''
+    missing, extra = diff(declared(), await existing())
+    backend = orm._backend
+    L = [backend.add_index_ddl(t, i.name, i.columns, i.unique) for t, i in missing]
+    L.extend('-- not declared: %s' % backend.drop_index_ddl(t, i.name) for t, i in extra)
+    return L
+
+def _usable(cls, columns):
+    # 最左前缀：where 里用到了索引的第一列，这个索引才用得上
+    if cls.__primary_key__ in columns:
+        return True
+    return any(i.columns[0] in columns for i in cls.__indexes__)
+
+def unindexed_queries():
+    '''
+    Recorded select shapes (see orm.metrics()) whose where clause has no declared index
+    on any of its columns: [dict(sql, table, columns, count, total_ms)].
+    '''
+    L = []
+    for sql, (t, r) in list(orm._statements.items()):
+        m = _RE_SELECT.match(sql)
+        if m is None or not m.group(2):
+            continue
+        cls = orm._models.get(m.group(1))
+        if cls is None:
+            continue
+        columns = set(w for w in _RE_WORD.findall(m.group(2)) if w in cls.__mappings__)
+        if columns and not _usable(cls, columns):
+            L.append(dict(sql=sql, table=cls.__table__, columns=sorted(columns), count=t.count, total_ms=t.total))
+    return sorted(L, key=lambda e: -e['total_ms'])
+
+async def main(loop):
+    import models
+    from config import configs
+    await orm.create_pool(loop=loop, **configs.db)
+    for ddl in await migration():
+        print(ddl)
+
+if __name__ == '__main__':
+    logging.disable(logging.INFO)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop))
@@ -0,0 +1,62 @@
+#coding:utf-8
+
+__author__ = 'Eric Lee'
+
+'''
+In-process histograms for runtime metrics.
+'''
+
+import bisect
+
+# 耗时的桶上界，毫秒
+TIME_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+# 行数/连接数的桶上界
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500, 1000, 5000, 10000)
+
+class Histogram(object):
+    '''
+    Fixed bucket histogram. Percentiles are the upper bound of the bucket they fall in.
+    >>> h = Histogram((1, 10, 100))
+    >>> for v in (0.5, 2, 3, 50, 500): h.observe(v)
+    >>> h.count, h.max, h.percentile(50), h.percentile(99)
+    (5, 500, 10, 500)
+    '''
+    def __init__(self, bounds=TIME_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1) # 最后一个桶是 > bounds[-1]
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def snapshot(self):
+        return dict(count=self.count, total=self.total, mean=self.mean, max=self.max,
+                    p50=self.percentile(50), p90=self.percentile(90), p99=self.percentile(99),
+                    buckets=[(b, n) for b, n in zip(self.bounds + ('+inf',), self.counts) if n])
+
+    def __str__(self):
+        return 'count=%d mean=%.2f p50=%s p90=%s p99=%s max=%.2f' \
+                % (self.count, self.mean, self.percentile(50), self.percentile(90), self.percentile(99), self.max)
+
+    __repr__ = __str__
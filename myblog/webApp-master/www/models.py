@@ -1,43 +1,51 @@
 #coding:utf-8
 __author__ = 'Eric Lee'
 
-import time, uuid
+import time
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, StringField, BooleanField, FloatField, TextField, Projection
+from ids import IdGenerator
+from config import configs
 
-def next_id():
-    return '%015d%s000'%(int(time.time()*1000), uuid.uuid4().hex)
+# 按时间递增的 13 位 id，见 ids.py；原来是 '%015d%s000'%(毫秒, uuid4().hex)，50 位
+next_id = IdGenerator(worker=configs.ids.worker)
 
 class User(Model):
     __table__ = 'users'
+    __counted__ = True # 维护行数计数器，见 orm.Model.count()
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    email = StringField(ddl='varchar(50)')
+    email = StringField(ddl='varchar(50)', index='unique')
     passwd = StringField(ddl='varchar(50)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)')
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
 
 class Blog(Model):
     __table__ = 'blogs'
+    __counted__ = True
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
+    id = StringField(primary_key=True, default=next_id, ddl='varchar(16)')
     user_id = StringField(ddl='varchar(50)')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
     content = TextField()
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
+
+    # 列表页不需要正文 content (mediumtext)
+    summary_view = Projection('id', 'user_id', 'user_name', 'user_image', 'name', 'summary', 'created_at')
 
 class Comment(Model):
     __table__ = 'comments'
+    __counted__ = True
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    blog_id = StringField(ddl='varchar(50)')
+    id = StringField(primary_key=True, default=next_id, ddl='varchar(16)')
+    blog_id = StringField(ddl='varchar(16)', references='Blog', index=True) # Blog 的 comments 关系
     user_id = StringField(ddl='varchar(50)')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
-    created_at = FloatField(default=time.time)
\ No newline at end of file
+    created_at = FloatField(default=time.time, index=True)
\ No newline at end of file
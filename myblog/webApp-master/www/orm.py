@@ -1,63 +1,701 @@
 #-*- coding: utf-8 -*-
 
 __author__ = 'Eric Lee'
-import asyncio, logging
-import aiomysql
+import asyncio, logging, functools, contextvars, collections, time
+import backends
+from metrics import Histogram, TIME_BUCKETS, COUNT_BUCKETS
 
+# 编译后语句的缓存上限：findAll/findNumber 每种查询形状(where + orderBy + limit 类型)占一项
+SQL_CACHE_SIZE = 256
+
+# 查询结果缓存：最多缓存的结果数和默认存活秒数
+QUERY_CACHE_SIZE = 1024
+QUERY_CACHE_TTL = 60
+
+# 慢查询：超过 SLOW_QUERY_MS 毫秒的语句记下来，最多保留 SLOW_QUERY_KEEP 种最慢的语句形状
+SLOW_QUERY_MS = 100
+SLOW_QUERY_KEEP = 20
+
+# 每条语句都记录太吵，只在 DEBUG 输出；慢查询由 slow_log 以 WARNING 输出
 def log(sql, args=()):
-    logging.info('SQL: %s, ARGS=%s'%(sql, args))
+    logging.debug('SQL: %s, ARGS=%s'%(sql, args))
+
+# 把 ? 占位符翻译成 aiomysql 使用的 %s，同一条语句只翻译一次 (sqlite 后端再翻译回 ?)
+@functools.lru_cache(maxsize=SQL_CACHE_SIZE)
+def compile_sql(sql):
+    return sql.replace('?', '%s')
+
+# 为 True 时当前请求(task)的读也走主库：刚写入的数据副本可能还没同步过来
+_read_primary = contextvars.ContextVar('read_primary', default=False)
+# 当前请求(task)里正在进行的事务，见 transaction()
+_transaction = contextvars.ContextVar('transaction', default=None)
+
+__pool = None
+__replicas = []
+__replica_index = 0
 
-@asyncio.coroutine
-def create_pool(loop, **kw):
+# 数据库后端，见 backends.py
+_backend = None
+
+# engine 是 'mysql' (aiomysql) 或 'sqlite' (进程内，用来跑 benchmark)
+# kw 是主库配置，replicas 是只读副本的配置列表，副本没有写的项沿用主库的
+async def create_pool(loop, replicas=(), engine='mysql', **kw):
     logging.info('create database connection pool...')
-    global __pool
-    __pool = yield from aiomysql.create_pool(
-        host=kw.get('host', 'localhost'),
-        port=kw.get('port', 3306),
-        user=kw.get('user','root'),
-        password=kw.get('password',''),
-        db=kw.get('db','testdb'),
-        charset=kw.get('charset', 'utf8'),
-        autocommit=kw.get('autocommit', True),
-        maxsize=kw.get('maxsize', 10),
-        minsize=kw.get('minsize', 1),
-        loop=loop
+    global __pool, __replicas, _backend
+    _backend = backends.get_backend(engine)
+    __pool = await _backend.create_pool(loop, **kw)
+    __replicas = []
+    for r in replicas:
+        cfg = dict(kw)
+        cfg.update(r)
+        logging.info('create replica connection pool: %s:%s' % (cfg.get('host', 'localhost'), cfg.get('port', 3306)))
+        __replicas.append(await _backend.create_pool(loop, **cfg))
+
+def pin_primary(pinned=True):
+    '''
+    Route reads of current request to primary. Return a token for unpin_primary().
+    '''
+    return _read_primary.set(pinned)
+
+def unpin_primary(token):
+    _read_primary.reset(token)
+
+# 读：从副本里轮询一个起点，再挑正在使用连接最少的；没有副本或者已钉住主库时用主库
+def _read_pool():
+    global __replica_index
+    if not __replicas or _read_primary.get():
+        return __pool
+    __replica_index = (__replica_index + 1) % len(__replicas)
+    candidates = __replicas[__replica_index:] + __replicas[:__replica_index]
+    return min(candidates, key=lambda p: p.size - p.freesize)
+
+class QueryCache(object):
+    '''
+    LRU cache of select results with TTL, opt-in by findAll(..., cache=True) / findNumber(..., cache=True).
+    Writes through the ORM invalidate the cache of that table. Each process has its own cache,
+    so writes from other processes are only seen after the TTL.
+    '''
+    def __init__(self, maxsize=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict() # key -> (expires, rs)
+        # 写表时版本号加一：写之前开始、写之后才返回的查询会存到旧版本下，不会再被命中
+        self._generations = collections.defaultdict(int)
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def key(self, table, sql, args, size=None):
+        return (table, self._epoch, self._generations[table], sql, tuple(args or ()), size)
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None or item[0] < time.time():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def put(self, key, rs, ttl=None):
+        self._data[key] = (time.time() + (ttl or self.ttl), rs)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def version(self, tables):
+        '''
+        Changes whenever one of tables is written through the ORM, for caches of data read from them.
+        '''
+        return (self._epoch,) + tuple(self._generations[t] for t in tables)
+
+    def invalidate(self, table=None):
+        '''
+        Drop cached results of table, or of all tables if table is None.
+        '''
+        self.invalidations += 1
+        if table is None:
+            self._epoch += 1
+            self._data.clear()
+            return
+        self._generations[table] += 1
+        for key in [k for k in self._data if k[0] == table]:
+            del self._data[key]
+
+    def stats(self):
+        return dict(size=len(self._data), maxsize=self.maxsize, ttl=self.ttl, hits=self.hits,
+                    misses=self.misses, evictions=self.evictions, invalidations=self.invalidations)
+
+query_cache = QueryCache()
+
+def cache_stats():
+    return query_cache.stats()
+
+# ------------------------------ 连接池和语句的运行指标 (毫秒) ------------------------------
+# 超过这个数量的语句形状都记到 '(other)' 下面，避免拼接出来的语句把内存撑大
+MAX_STATEMENT_SHAPES = 256
+
+acquire_histogram = Histogram(TIME_BUCKETS) # 等待连接的时间
+in_use_histogram = Histogram(COUNT_BUCKETS) # 拿到连接时池里正在使用的连接数
+_statements = collections.OrderedDict() # sql -> (耗时 Histogram, 行数 Histogram)
+
+def _acquired(pool, start):
+    acquire_histogram.observe((time.perf_counter() - start) * 1000)
+    in_use_histogram.observe(pool.size - pool.freesize)
+
+def _shape(sql):
+    if len(sql) > 200:
+        return sql[:200] + '...' # 多行 insert
+    return sql
+
+def _record(sql, start, rows, args=None):
+    ms = (time.perf_counter() - start) * 1000
+    shape = _shape(sql)
+    st = _statements.get(shape)
+    if st is None:
+        if len(_statements) >= MAX_STATEMENT_SHAPES:
+            shape = '(other)'
+        st = _statements.setdefault(shape, (Histogram(TIME_BUCKETS), Histogram(COUNT_BUCKETS)))
+    st[0].observe(ms)
+    st[1].observe(rows)
+    if ms >= slow_log.threshold:
+        entry = slow_log.observe(_shape(sql), ms, args)
+        if entry is not None and slow_log.explain and not entry['explained'] and sql.lstrip().lower().startswith('select'):
+            entry['explained'] = True
+            asyncio.ensure_future(_explain(entry, sql, args))
+
+class SlowQueryLog(object):
+    '''
+    Keep the slowest statement shapes over threshold (ms), with the args of their slowest run
+    and the EXPLAIN plan captured once per shape.
+    '''
+    def __init__(self, threshold=SLOW_QUERY_MS, keep=SLOW_QUERY_KEEP, explain=True):
+        self.threshold = threshold
+        self.keep = keep
+        self.explain = explain
+        self._entries = dict() # shape -> entry
+
+    def observe(self, shape, ms, args):
+        entry = self._entries.get(shape)
+        if entry is None:
+            if len(self._entries) >= self.keep:
+                fastest = min(self._entries.values(), key=lambda e: e['max'])
+                if fastest['max'] >= ms:
+                    return None
+                del self._entries[fastest['sql']]
+            entry = self._entries[shape] = dict(sql=shape, count=0, max=0, args=None, explained=False, plan=None, warnings=[])
+        entry['count'] += 1
+        if ms > entry['max']:
+            entry['max'] = ms
+            entry['args'] = list(args) if args else args
+        logging.warning('slow query %.1f ms: %s, ARGS=%s' % (ms, shape, args))
+        return entry
+
+    def entries(self):
+        '''
+        Slowest first. count is the number of slow runs, all_count/p50/p99 cover every run of the shape.
+        '''
+        L = []
+        for e in sorted(self._entries.values(), key=lambda e: -e['max']):
+            e = dict(e)
+            st = _statements.get(e['sql'])
+            if st is not None:
+                e.update(all_count=st[0].count, p50=st[0].percentile(50), p99=st[0].percentile(99))
+            L.append(e)
+        return L
+
+    def clear(self):
+        self._entries.clear()
+
+slow_log = SlowQueryLog()
+
+def slow_queries():
+    return slow_log.entries()
+
+# 在执行计划里找全表扫描和文件排序，比如 comments 上没有 blog_id 索引时 get_blog 的查询
+def _plan_warnings(plan):
+    L = []
+    for row in plan:
+        if row.get('type') == 'ALL':
+            L.append('full table scan on `%s` (%s rows), possible keys: %s' % (row.get('table'), row.get('rows'), row.get('possible_keys')))
+        if 'filesort' in (row.get('Extra') or ''):
+            L.append('filesort on `%s`' % row.get('table'))
+        # sqlite 的 explain query plan：SEARCH 是按索引查找，SCAN 即使 USING INDEX 也要走完整张表
+        detail = row.get('detail') or ''
+        if detail.startswith('SCAN '):
+            L.append('full table scan: %s' % detail)
+        if 'TEMP B-TREE' in detail:
+            L.append('filesort: %s' % detail)
+    return L
+
+async def _explain(entry, sql, args):
+    try:
+        async with _read_pool().acquire() as conn:
+            cur = await conn.cursor(_backend.dict_cursor)
+            await cur.execute(_backend.explain_prefix + sql, args or ())
+            entry['plan'] = await cur.fetchall()
+            await cur.close()
+    except Exception as e:
+        logging.warning('explain failed: %s: %s' % (entry['sql'], e))
+        return
+    entry['warnings'] = _plan_warnings(entry['plan'])
+    for w in entry['warnings']:
+        logging.warning('slow query %s: %s' % (entry['sql'], w))
+
+def _pools():
+    L = [('primary', __pool)] if __pool is not None else []
+    L.extend(('replica%d' % i, p) for i, p in enumerate(__replicas))
+    return L
+
+def pool_stats():
+    return dict((name, dict(size=p.size, idle=p.freesize, in_use=p.size - p.freesize, minsize=p.minsize, maxsize=p.maxsize))
+                for name, p in _pools())
+
+def metrics():
+    '''
+    Snapshot of pool and statement metrics, times in milliseconds.
+    '''
+    return dict(
+        pools=pool_stats(),
+        acquire=acquire_histogram.snapshot(),
+        in_use=in_use_histogram.snapshot(),
+        statements=dict((sql, dict(time=t.snapshot(), rows=r.snapshot())) for sql, (t, r) in _statements.items()),
+        cache=cache_stats(),
+        slow_queries=slow_queries()
     )
 
-@asyncio.coroutine
-def select(sql, args, size=None):
+def dump_metrics():
+    L = ['pools:']
+    for name, st in pool_stats().items():
+        L.append('  %(name)-10s size=%(size)s in_use=%(in_use)s idle=%(idle)s maxsize=%(maxsize)s' % dict(st, name=name))
+    L.append('acquire wait (ms): %s' % acquire_histogram)
+    L.append('in use on acquire: %s' % in_use_histogram)
+    L.append('statements (ms / rows):')
+    for sql, (t, r) in sorted(_statements.items(), key=lambda item: -item[1][0].total):
+        L.append('  %s\n    time: %s\n    rows: %s' % (sql, t, r))
+    L.append('cache: %s' % cache_stats())
+    L.append('slow queries (> %s ms):' % slow_log.threshold)
+    for e in slow_queries():
+        L.append('  %.1f ms x%s: %s, ARGS=%s' % (e['max'], e['count'], e['sql'], e['args']))
+        if 'all_count' in e:
+            L.append('    all runs: count=%(all_count)s p50=%(p50)s p99=%(p99)s' % e)
+        for w in e['warnings']:
+            L.append('    ! %s' % w)
+    return '\n'.join(L)
+
+async def select(sql, args, size=None):
+    return await _select(compile_sql(sql), args, size)
+
+# sql 已经是 compile_sql() 翻译过的语句
+async def _select(sql, args, size=None):
     log(sql, args)
-    global __pool
+    tx = _transaction.get()
+    if tx is not None:
+        return await tx._query(sql, args, size)
+    pool = _read_pool()
+    start = time.perf_counter()
     #直接__pool就可以，为什么要get()?
-    with (yield from __pool) as conn:
-        cur =  yield from conn.cursor(aiomysql.DictCursor)  #get cursor()
-        yield from cur.execute(sql.replace('?','%s'),args or ())
+    async with pool.acquire() as conn:
+        _acquired(pool, start)
+        start = time.perf_counter()
+        cur =  await conn.cursor(_backend.dict_cursor)  #get cursor()
+        await cur.execute(sql, args or ())
         if size:
-            rs = yield from cur.fetchmany(size)
+            rs = await cur.fetchmany(size)
         else:
-            rs = yield from cur.fetchall()
+            rs = await cur.fetchall()
         # 关闭游标，不用手动关闭conn，因为是在with语句里面，会自动关闭，因为是select，所以不需要提交事务(commit)
-        yield from cur.close()
+        await cur.close()
+        _record(sql, start, len(rs), args)
         logging.info('rows returned: %s'%len(rs))
         return rs
 
-@asyncio.coroutine
-def execute(sql, args, autocommit=True):
-    print(sql,args)
-    log(sql)
-    with (yield from __pool) as conn:
+# cache 为 True 用默认 TTL，为数字时是 TTL 秒数，为空时不走缓存
+async def _cached_select(table, sql, args, size=None, cache=None):
+    # 事务里可能读到还没提交的数据，不能放进缓存
+    if not cache or _transaction.get() is not None:
+        return await _select(sql, args, size)
+    key = query_cache.key(table, sql, args, size)
+    rs = query_cache.get(key)
+    if rs is None:
+        rs = await _select(sql, args, size)
+        query_cache.put(key, rs, None if cache is True else cache)
+    return rs
+
+# 不知道写的是哪张表，清掉全部缓存
+async def execute(sql, args, autocommit=True):
+    return await _execute(compile_sql(sql), args, autocommit)
+
+async def _execute(sql, args, autocommit=True, table=None):
+    log(sql, args)
+    tx = _transaction.get()
+    if tx is not None:
+        return await tx._execute(sql, args, table)
+    # 写一律走主库，之后本请求的读也钉在主库上
+    _read_primary.set(True)
+    start = time.perf_counter()
+    async with __pool.acquire() as conn:
+        _acquired(__pool, start)
+        start = time.perf_counter()
         if not autocommit:
-            yield from conn.begin()
+            await conn.begin()
         try:
-            cur = yield from conn.cursor(aiomysql.DictCursor)
-            yield from cur.execute(sql.replace('?', '%s'), args or ())
+            cur = await conn.cursor(_backend.dict_cursor)
+            await cur.execute(sql, args or ())
             affected = cur.rowcount
+            _record(sql, start, affected, args)
             if not autocommit:
-                yield from cur.commit()
+                await conn.commit()
+        except BaseException as e:
+            if not autocommit:
+                await conn.rollback()
+            raise
+        finally:
+            query_cache.invalidate(table)
+        return affected
+
+# 在同一个连接、同一个事务里执行一组 (sql, args)，sql 已经翻译过占位符
+async def _execute_many(stmts, table=None):
+    tx = _transaction.get()
+    if tx is not None:
+        affected = 0
+        for sql, args in stmts:
+            affected += await tx._execute(sql, args, table)
+        return affected
+    _read_primary.set(True)
+    start = time.perf_counter()
+    async with __pool.acquire() as conn:
+        _acquired(__pool, start)
+        await conn.begin()
+        try:
+            affected = 0
+            cur = await conn.cursor()
+            for sql, args in stmts:
+                log(sql)
+                start = time.perf_counter()
+                await cur.execute(sql, args)
+                affected += cur.rowcount
+                _record(sql, start, cur.rowcount)
+            await cur.close()
+            await conn.commit()
         except BaseException as e:
+            await conn.rollback()
             raise
+        finally:
+            query_cache.invalidate(table)
         return affected
 
+def _primary():
+    return __pool
+
+class Transaction(object):
+    '''
+    One pooled connection and one transaction for every ORM statement run inside it:
+
+        async with orm.transaction():
+            await blog.remove()
+            await orm.execute('delete from `comments` where `blog_id`=?', [blog.id])
+
+    or for a coroutine function (also a legacy yield-from one): await orm.transaction().run(fn, *args)
+    Commit once at the end, rollback on exception. A transaction started inside another one joins it.
+    Statements of one transaction must not run concurrently.
+    '''
+    def __init__(self):
+        self._pool = None
+        self._conn = None
+        self._token = None
+        self._outer = None
+        self._tables = set()
+
+    async def begin(self):
+        self._outer = _transaction.get()
+        if self._outer is None:
+            self._pool = _primary()
+            start = time.perf_counter()
+            self._conn = await self._pool.acquire()
+            _acquired(self._pool, start)
+            try:
+                await self._conn.begin()
+            except BaseException as e:
+                await self._pool.release(self._conn)
+                raise
+        self._token = _transaction.set(self._outer or self)
+        return self
+
+    async def commit(self):
+        await self._end(True)
+
+    async def rollback(self):
+        await self._end(False)
+
+    async def _end(self, commit):
+        _transaction.reset(self._token)
+        _read_primary.set(True)
+        if self._outer is not None:
+            return
+        conn, self._conn = self._conn, None
+        try:
+            if commit:
+                await conn.commit()
+            else:
+                await conn.rollback()
+        finally:
+            # 提交之后再让缓存失效，避免其它请求把提交前的数据重新缓存
+            for table in self._tables:
+                query_cache.invalidate(table)
+            await self._pool.release(conn)
+
+    async def run(self, fn, *args, **kw):
+        await self.begin()
+        try:
+            r = await fn(*args, **kw)
+        except BaseException as e:
+            await self.rollback()
+            raise
+        await self.commit()
+        return r
+
+    async def __aenter__(self):
+        return await self.begin()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._end(exc_type is None)
+
+    async def _query(self, sql, args, size=None):
+        start = time.perf_counter()
+        cur = await self._conn.cursor(_backend.dict_cursor)
+        await cur.execute(sql, args or ())
+        if size:
+            rs = await cur.fetchmany(size)
+        else:
+            rs = await cur.fetchall()
+        await cur.close()
+        _record(sql, start, len(rs), args)
+        return rs
+
+    async def _execute(self, sql, args, table=None):
+        start = time.perf_counter()
+        cur = await self._conn.cursor(_backend.dict_cursor)
+        await cur.execute(sql, args or ())
+        affected = cur.rowcount
+        await cur.close()
+        _record(sql, start, affected, args)
+        self._tables.add(table)
+        return affected
+
+def transaction():
+    return Transaction()
+
+# ------------------------------------ 计数器 ------------------------------------
+# 表的行数、一对多关系里每个父记录的子记录数存在 counters 表里，代替列表页每次的 count(id)：
+# save()/remove() 在同一个事务里更新，读走 query_cache (写计数器时失效)，reconcile_counters() 定期用 count 校正
+COUNTER_TABLE = 'counters'
+COUNTER_TTL = 60
+COUNTER_RECONCILE_INTERVAL = 3600
+
+@functools.lru_cache(maxsize=SQL_CACHE_SIZE)
+def _counters_sql(n):
+    return compile_sql('select `name`, `value` from `%s` where `name` in (%s)'%(COUNTER_TABLE, create_args_string(n)))
+
+async def counter_values(names):
+    '''
+    Values of counters (see Model.counter()), 0 for a counter never written.
+    '''
+    names = list(names)
+    if not names:
+        return []
+    n, args = _padded(list(dict.fromkeys(names)))
+    rs = await _cached_select(COUNTER_TABLE, _counters_sql(n), args, cache=COUNTER_TTL)
+    found = dict((r['name'], r['value']) for r in rs)
+    return [found.get(name, 0) for name in names]
+
+async def add_counters(deltas):
+    '''
+    Add [(name, delta)] to counters, inside the current transaction if there is one.
+    Needed after writes with execute() that bypass save()/remove().
+    '''
+    stmts = [(_backend.counter_add, [name, delta]) for name, delta in deltas if delta]
+    if stmts:
+        await _execute_many(stmts, COUNTER_TABLE)
+
+# write() 返回影响的行数；有影响时 deltas 和写入在同一个事务里提交或回滚
+async def _with_counters(write, deltas):
+    if not deltas:
+        return await write()
+    return await transaction().run(_write_and_count, write, deltas)
+
+async def _write_and_count(write, deltas):
+    rows = await write()
+    if rows:
+        await add_counters(deltas)
+    return rows
+
+async def reconcile_counters():
+    '''
+    Recount every counter of __counted__ models, fixing drift from writes that bypassed the ORM.
+    A write committed while its table is being recounted may be missed until the next run.
+    Creates the counters table first when an existing database does not have it yet.
+    '''
+    await _execute(_backend.counters_ddl, None, table=COUNTER_TABLE)
+    for table, cls in sorted(_models.items()):
+        if cls.__counted__:
+            await transaction().run(_recount, cls)
+
+async def _recount(cls):
+    pk = cls.__primary_key__
+    rs = await _select(compile_sql('select count(`%s`) _num_ from `%s`'%(pk, cls.__table__)), None, 1)
+    stmts = [(_backend.counter_set, [cls.__table__, rs[0]['_num_']])]
+    for fk in cls.__counted_by__:
+        prefix = '%s.%s:'%(cls.__table__, fk)
+        # 子记录删光了的父记录不会出现在 group by 的结果里，先清掉再重建
+        await _execute(compile_sql('delete from `%s` where `name` like ?'%COUNTER_TABLE), [prefix + '%'], table=COUNTER_TABLE)
+        rs = await _select(compile_sql('select `%s` _fk_, count(`%s`) _num_ from `%s` group by `%s`'%(fk, pk, cls.__table__, fk)), None)
+        stmts.extend((_backend.counter_set, [prefix + str(r['_fk_']), r['_num_']]) for r in rs)
+    await _execute_many(stmts, COUNTER_TABLE)
+    logging.info('reconciled counters of %s'%cls.__table__)
+
+async def keep_counters(interval=COUNTER_RECONCILE_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await reconcile_counters()
+        except Exception as e:
+            logging.exception(e)
+
+class ModelStream(object):
+    '''
+    Async iterator of model instances, read batch by batch through an unbuffered server-side cursor.
+
+        async with Blog.stream(batch_size=500) as blogs:
+            async for blog in blogs:
+                ...
+    '''
+    def __init__(self, cls, sql, args, batch_size):
+        self._cls = cls
+        self._sql = sql
+        self._args = args
+        self._batch_size = batch_size
+        self._pool = None
+        self._conn = None
+        self._cur = None
+        self._rows = collections.deque()
+        self._exhausted = False
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._rows:
+            if self._closed:
+                raise StopAsyncIteration
+            try:
+                await self._fetch()
+            except BaseException as e:
+                # 出错或者被取消，马上归还连接
+                await self.close()
+                raise
+            if not self._rows:
+                await self.close()
+                raise StopAsyncIteration
+        return self._rows.popleft()
+
+    async def _fetch(self):
+        if self._conn is None:
+            log(self._sql, self._args)
+            self._pool = _read_pool()
+            start = time.perf_counter()
+            self._conn = await self._pool.acquire()
+            _acquired(self._pool, start)
+            self._cur = await self._conn.cursor(_backend.ss_cursor)
+            await self._cur.execute(self._sql, self._args or ())
+        rs = await self._cur.fetchmany(self._batch_size)
+        if not rs:
+            self._exhausted = True
+        self._rows.extend(self._cls.__hydrate__(rs))
+
+    async def close(self):
+        '''
+        Release the connection back to pool. Safe to call more than once.
+        '''
+        self._closed = True
+        self._rows.clear()
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        if self._exhausted:
+            await self._cur.close()
+        else:
+            # 没读完的无缓冲结果集只能一行行读掉，直接关闭连接更快，连接池会丢弃已关闭的连接
+            conn.close()
+        await self._pool.release(conn)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+# 一次 in (...) 最多查的主键数；批量大小向上取到 2 的幂，语句形状只有几种
+LOADER_MAX_BATCH = 128
+
+class Loader(object):
+    '''
+    Batch find(pk) calls issued in the same event loop iteration into one select ... where pk in (...).
+    Identical keys share one pending lookup (single-flight).
+    '''
+    def __init__(self, cls, max_batch=LOADER_MAX_BATCH):
+        self._cls = cls
+        self._max_batch = max_batch
+        self._pending = dict() # 等待下一次批量查询的 pk -> future
+        self._inflight = dict() # 正在查询的 pk -> future
+
+    def load(self, pk):
+        '''
+        Return a future of the raw row (dict) of pk, or None if not found.
+        '''
+        fut = self._pending.get(pk) or self._inflight.get(pk)
+        if fut is None:
+            loop = asyncio.get_event_loop()
+            if not self._pending:
+                loop.call_soon(self._dispatch)
+            fut = self._pending[pk] = loop.create_future()
+        return fut
+
+    def _dispatch(self):
+        pending, self._pending = self._pending, dict()
+        self._inflight.update(pending)
+        pks = list(pending)
+        for i in range(0, len(pks), self._max_batch):
+            asyncio.ensure_future(self._fetch(pks[i:i + self._max_batch], pending))
+
+    async def _fetch(self, pks, pending):
+        n, args = _padded(pks)
+        found, error = None, None
+        try:
+            rs = await _select(_find_in_sql(self._cls, n), args)
+            found = dict((r[self._cls.__primary_key__], r) for r in rs)
+        except Exception as e:
+            error = e
+        finally:
+            # 被取消 (CancelledError 不是 Exception) 时也要了结所有 future，否则等这一批的调用方会一直挂着
+            for pk in pks:
+                self._inflight.pop(pk, None)
+                fut = pending[pk]
+                if fut.done():
+                    continue
+                if found is not None:
+                    fut.set_result(found.get(pk))
+                elif error is not None:
+                    fut.set_exception(error)
+                else:
+                    fut.cancel()
+
 def create_args_string(num):
     L = []
     for n in range(num):
@@ -65,35 +703,76 @@ def create_args_string(num):
     return ','.join(L)
 
 class Field(object):
-    def __init__(self, name, column_type, primary_key, default):
+    def __init__(self, name, column_type, primary_key, default, references=None, index=False):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        self.references = references # 外键指向的模型类名，例如 Comment.blog_id -> 'Blog'
+        self.index = index # True: 单列索引 idx_<列名>；'unique': 唯一索引
 
     def __str__(self):
         return '<%s, %s, %s>'%(self.__class__.__name__, self.column_type, self.name)
 
 class StringField(Field):
-    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100）'):
-        super().__init__(name, ddl, primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100）', references=None, index=False):
+        super().__init__(name, ddl, primary_key, default, references, index)
 
 class BooleanField(Field):
-    def __init__(self, name=None,default=False):
-        super().__init__(name, 'boolean', False, default)
+    def __init__(self, name=None,default=False, index=False):
+        super().__init__(name, 'boolean', False, default, index=index)
 
 class IntegerField(Field):
-    def __init__(self, name=None,  primary_key=False, default=0):
-        super().__init__(name, 'bigint', primary_key, default)
+    def __init__(self, name=None,  primary_key=False, default=0, index=False):
+        super().__init__(name, 'bigint', primary_key, default, index=index)
 
 class FloatField(Field):
-    def __init__(self, name=None,  primary_key=False, default=0.0):
-        super().__init__(name, 'real', primary_key, default)
+    def __init__(self, name=None,  primary_key=False, default=0.0, index=False):
+        super().__init__(name, 'real', primary_key, default, index=index)
 
 class TextField(Field):
     def __init__(self, name=None, default=None):
         super().__init__(name, 'text', False, default)
 
+class Projection(object):
+    '''
+    Named subset of columns, e.g. Blog.summary_view, used as findAll(columns=Blog.summary_view).
+    '''
+    def __init__(self, *columns):
+        self.columns = tuple(columns)
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __str__(self):
+        return '<%s, %s>'%(self.__class__.__name__, ','.join(self.columns))
+
+class Index(object):
+    '''
+    Multi-column index declared on a model, e.g. idx_blog_created = Index('blog_id', 'created_at').
+    The attribute name is the index name. Single-column indexes use Field(index=True).
+    '''
+    def __init__(self, *columns, unique=False, name=None):
+        self.columns = tuple(columns)
+        self.unique = unique
+        self.name = name
+
+    def __eq__(self, other):
+        return isinstance(other, Index) and (self.columns, self.unique) == (other.columns, other.unique)
+
+    def __hash__(self):
+        return hash((self.columns, self.unique))
+
+    def __str__(self):
+        return '<%s, %s, %s%s>'%(self.__class__.__name__, self.name, ','.join(self.columns), ', unique' if self.unique else '')
+
+    __repr__ = __str__
+
+# 模型之间的一对多关系：父模型类名 -> {关系名(子表名): (子模型, 外键字段)}
+_relations = collections.defaultdict(dict)
+# 表名 -> 模型，索引顾问用 (见 indexes.py)
+_models = dict()
+
 #类--》父类--》元类:继承关系
 class ModelMetaClass(type):
     def __new__(cls, name, bases, attrs):
@@ -118,34 +797,250 @@ class ModelMetaClass(type):
             raise RuntimeError('primary key not found')
         for k in mappings.keys():
             attrs.pop(k)
+        # 声明的索引：Field(index=...) 的单列索引 + 类属性里的 Index
+        indexes = [Index(k, unique=(v.index == 'unique'), name='idx_%s'%k) for k, v in mappings.items() if v.index]
+        for k, v in list(attrs.items()):
+            if isinstance(v, Index):
+                v.name = v.name or k
+                indexes.append(_check_index(mappings, attrs.pop(k)))
+        for k, v in attrs.items():
+            if isinstance(v, Projection):
+                # 主键总是要查出来，部分加载的对象靠它补齐其余列
+                v.columns = _check_columns(mappings, primarykey, v.columns)
         escaped_fields = list(map(lambda f: '`%s`'%f, fields))#['`field1`','`field2`'] 提取属性名(字段名)成list
         attrs['__mappings__'] = mappings
         attrs['__table__'] = tableName
         attrs['__primary_key__'] = primarykey #主键名
         attrs['__fields__'] = fields #除主键外的属性名
+        attrs['__indexes__'] = tuple(indexes)
+        # __counted__ = True 的模型维护行数计数器，有 references 的列再按父记录计数，见 Model.count()
+        attrs['__counted__'] = attrs.get('__counted__', False)
+        attrs['__counted_by__'] = tuple(k for k, v in mappings.items() if v.references)
         #直接封装sql语法
         attrs['__select__'] = 'select `%s`, %s from `%s`'%(primarykey,','.join(escaped_fields),tableName)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)'%(tableName,','.join(escaped_fields),primarykey,create_args_string(len(escaped_fields)+1))
         attrs['__update__'] = 'update `%s` set %s where `%s`=?'%(tableName,','.join(map(lambda f: '`%s`=?'%(mappings.get(f).name or f), fields)),primarykey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?'%(tableName, primarykey)
-        return type.__new__(cls, name, bases, attrs)
+        # 建类时就翻译好占位符，save/update/remove/find 直接使用
+        attrs['__compiled__'] = dict(
+            select=compile_sql(attrs['__select__']),
+            find=compile_sql('%s where `%s`=?'%(attrs['__select__'], primarykey)),
+            insert=compile_sql(attrs['__insert__']),
+            update=compile_sql(attrs['__update__']),
+            delete=compile_sql(attrs['__delete__'])
+        )
+        attrs['__columns__'] = (primarykey,) + tuple(fields)
+        klass = type.__new__(cls, name, bases, attrs)
+        # 紧凑的行类：每列一个 slot，共用模型的元数据和方法
+        row_attrs = dict((k, v) for k, v in attrs.items() if k not in ('__module__', '__qualname__'))
+        row_attrs['__slots__'] = attrs['__columns__']
+        row_attrs['__module__'] = attrs.get('__module__')
+        row_attrs['__model__'] = klass
+        row = type('%sRow'%name, (ModelRow,), row_attrs)
+        row.__row__ = row
+        klass.__row__ = row
+        klass.__hydrate__ = row.__hydrate__ = staticmethod(_hydrate_function(row))
+        row.to_dict = _to_dict_function(row)
+        # insert 的参数顺序是 __fields__ + 主键，和 __insert__ 一致
+        for c in (klass, row):
+            c.__insert_args__ = _values_function(c, 'insert_args', attrs['__fields__'] + [primarykey], defaults=True)
+            c.__update_args__ = _values_function(c, 'update_args', attrs['__fields__'] + [primarykey])
+        klass.__loader__ = row.__loader__ = Loader(klass)
+        klass.__model__ = klass
+        for k, v in mappings.items():
+            if v.references:
+                _relations[v.references][tableName] = (klass, k)
+        _models[tableName] = klass
+        return klass
 
-class Model(dict,metaclass=ModelMetaClass):
-    def __init__(self, **kw):
-        super(Model, self).__init__(**kw)
+# ------------------------------ 建类时为每个模型生成的函数 ------------------------------
+# 逐列展开成直线代码：运行时不再遍历 __fields__、查 __mappings__、判断 default 是否 callable
+def _compile_function(name, params, body, namespace):
+    src = 'def %s(%s):\n    %s\n' % (name, params, '\n    '.join(body))
+    exec(compile(src, '<orm %s>' % name, 'exec'), namespace)
+    return namespace[name]
 
-    def __getattr__(self, key):
-        try:
-            return self[key]
-        except KeyError:
-            raise AttributeError(r"'Model' object has no attribute '%s'"%key)
+# 整行的 dict -> 行对象：直接用每列 slot 的描述符赋值，绕过 __setattr__ 的修改跟踪
+def _hydrate_function(row):
+    ns = dict(new=_new_row, Row=row)
+    body = ['L = []', 'append = L.append', 'for r in rs:', '    obj = new(Row)']
+    for i, c in enumerate(row.__columns__):
+        ns['set%d' % i] = row.__dict__[c].__set__
+        body.append('    set%d(obj, r[%r])' % (i, c))
+    body.extend(['    append(obj)', 'return L'])
+    return _compile_function('hydrate_%s' % row.__name__, 'rs', body, ns)
 
-    def __setattr__(self, key, value):
-        self[key] = value
+# 行对象 -> dict，结果和 ModelRow.to_dict() 一样：部分加载时跳过 __missing__ 里的列，
+# 还有没赋值的 slot 时退回通用版本
+def _to_dict_function(row):
+    ns = dict(to_dict=ModelRow.to_dict)
+    body = ['extra = self.__dict__', "missing = extra.get('__missing__', ())", 'd = {}', 'try:']
+    for i, c in enumerate(row.__columns__):
+        ns['get%d' % i] = row.__dict__[c].__get__
+        body.extend(['    if %r not in missing:' % c, '        d[%r] = get%d(self)' % (c, i)])
+    body.extend(['except AttributeError:', '    return to_dict(self)',
+                 'for k, v in extra.items():', "    if not k.startswith('__'):", '        d[k] = v', 'return d'])
+    return _compile_function('to_dict_%s' % row.__name__, 'self', body, ns)
+
+# 对象 -> 参数列表。defaults=True 时和 getValueOrDefault() 一样，为 None 的列取默认值并写回对象
+def _values_function(cls, name, columns, defaults=False):
+    # dict 版的 Model 用 dict.get，行对象用 getattr 读 slot
+    if issubclass(cls, dict):
+        get, put = 'self.get(%r)', 'self[%r] = v%d'
+    else:
+        get, put = 'getattr(self, %r, None)', 'setattr(self, %r, v%d)'
+    ns = dict()
+    body = []
+    for i, c in enumerate(columns):
+        body.append('v%d = %s' % (i, get % c))
+        default = cls.__mappings__[c].default if defaults else None
+        if default is not None:
+            ns['d%d' % i] = default
+            body.append('if v%d is None:' % i)
+            body.append('    v%d = d%d%s' % (i, i, '()' if callable(default) else ''))
+            body.append('    ' + put % (c, i))
+    body.append('return [%s]' % ', '.join('v%d' % i for i in range(len(columns))))
+    return _compile_function('%s_%s' % (name, cls.__name__), 'self', body, ns)
+
+def _check_index(mappings, index):
+    for c in index.columns:
+        if c not in mappings:
+            raise ValueError('Invalid column in index %s: %s'%(index.name, c))
+    return index
+
+def _check_columns(mappings, primarykey, columns):
+    for c in columns:
+        if c not in mappings:
+            raise ValueError('Invalid column: %s'%c)
+    return (primarykey,) + tuple(c for c in columns if c != primarykey)
+
+@functools.lru_cache(maxsize=SQL_CACHE_SIZE)
+def _select_sql(cls, columns):
+    if columns is None:
+        return cls.__select__
+    return 'select %s from `%s`'%(','.join(map(lambda f: '`%s`'%f, columns)), cls.__table__)
+
+# keyset 分页：按 (created_at, id) 倒序，从游标之后开始取，不需要扫描并丢弃 offset 行
+KEYSET_WHERE = '(`created_at`, `id`) < (?, ?)'
+KEYSET_ORDER_BY = '`created_at` desc, `id` desc'
+
+# findAll 的语句只取决于查询形状，limit 只区分 无/limit ?/limit ?,? 三种 (0/1/2)
+@functools.lru_cache(maxsize=SQL_CACHE_SIZE)
+def _find_all_sql(cls, where, orderBy, limit, after=False, columns=None):
+    sql = [_select_sql(cls, columns)]
+    if after:
+        where = '(%s) and %s'%(where, KEYSET_WHERE) if where else KEYSET_WHERE
+        orderBy = KEYSET_ORDER_BY
+    if where:
+        sql.append('where')
+        sql.append(where)
+    if orderBy:
+        sql.append('order by')
+        sql.append(orderBy)
+    if limit == 1:
+        sql.append('limit ?')
+    elif limit == 2:
+        sql.append('limit ?,?')
+    return compile_sql(' '.join(sql))
+
+# in (...) 的参数补齐到 2 的幂个，语句形状只有几种
+def _padded(values):
+    n = 1
+    while n < len(values):
+        n *= 2
+    return n, values + values[-1:] * (n - len(values))
+
+@functools.lru_cache(maxsize=SQL_CACHE_SIZE)
+def _children_sql(child, fk, n):
+    sql = '%s where `%s` in (%s)'%(child.__select__, fk, create_args_string(n))
+    if 'created_at' in child.__mappings__:
+        sql = '%s order by %s'%(sql, KEYSET_ORDER_BY)
+    return compile_sql(sql)
+
+@functools.lru_cache(maxsize=SQL_CACHE_SIZE)
+def _children_count_sql(child, fk, n):
+    return compile_sql('select `%s` _fk_, count(*) _num_ from `%s` where `%s` in (%s) group by `%s`'%(fk, child.__table__, fk, create_args_string(n), fk))
+
+@functools.lru_cache(maxsize=SQL_CACHE_SIZE)
+def _find_in_sql(cls, n):
+    return compile_sql('%s where `%s` in (%s)'%(cls.__select__, cls.__primary_key__, create_args_string(n)))
+
+# insert into `t` (...) values (?,..),(?,..)... 一条语句插入 rows 行
+@functools.lru_cache(maxsize=16)
+def _insert_many_sql(cls, rows):
+    head, sep, values = cls.__insert__.partition(' values ')
+    return (head + sep + ','.join([values] * rows)).replace('?', '%s')
+
+# update() 只写改过的列：每种改动列的组合编译一次语句和取参数的函数
+@functools.lru_cache(maxsize=SQL_CACHE_SIZE)
+def _update_plan(cls, fields):
+    sql = compile_sql('update `%s` set %s where `%s`=?'%(cls.__table__, ','.join(map(lambda f: '`%s`=?'%(cls.__mappings__.get(f).name or f), fields)), cls.__primary_key__))
+    return sql, _values_function(cls, 'update_args', fields + (cls.__primary_key__,))
+
+@functools.lru_cache(maxsize=SQL_CACHE_SIZE)
+def _find_number_sql(cls, selectField, where):
+    sql = ['select %s _num_ from `%s`'%(selectField, cls.__table__)]
+    if where:
+        sql.append('where')
+        sql.append(where)
+    return compile_sql(' '.join(sql))
+
+# Model 和 ModelRow 共用的方法，只通过 getattr/setattr 读写字段
+class ModelBase(object):
+    __slots__ = ()
+
+    # 从数据库读出的整行都构造成紧凑的行对象 cls.__row__，见 _hydrate_function()
+    @classmethod
+    def _hydrate(cls, rs):
+        return cls.__hydrate__(rs)
+
+    # findAll(columns=...) 返回的部分加载对象：记下没查出来的列
+    @classmethod
+    def _partial(cls, columns, rs):
+        missing = frozenset(cls.__mappings__) - frozenset(columns)
+        from_dict = cls.__row__._from_dict
+        L = [from_dict(r) for r in rs]
+        for obj in L:
+            obj.__dict__['__missing__'] = missing
+        return L
+
+    @classmethod
+    def _columns(cls, columns):
+        if columns is None:
+            return None
+        if isinstance(columns, Projection):
+            return columns.columns
+        return _check_columns(cls.__mappings__, cls.__primary_key__, columns)
+
+    async def load(self, *fields):
+        '''
+        Fetch the columns skipped by findAll(columns=...), all of them if no field is given.
+        '''
+        missing = self.__dict__.get('__missing__')
+        if not missing:
+            return self
+        # 已经赋过值的列不要被数据库里的旧值覆盖
+        dirty = self._dirty() or _CLEAN
+        fields = tuple(f for f in self.__fields__ if f in missing and f not in dirty and (not fields or f in fields))
+        if fields:
+            sql = compile_sql('%s where `%s`=?'%(_select_sql(self.__class__, fields), self.__primary_key__))
+            rs = await _select(sql, [self.getValue(self.__primary_key__)], 1)
+            if rs:
+                for k, v in rs[0].items():
+                    _set(self, k, v) # 只有行对象会部分加载；读出来的值不算修改
+            self.__dict__['__missing__'] = missing - frozenset(fields)
+        return self
 
     def getValue(self, key):
         return getattr(self, key, None)
 
+    # 自读出/写入以来改过的列；None 表示不跟踪 (dict 版的 Model)，update() 写所有列
+    def _dirty(self):
+        return None
+
+    def _clean(self):
+        pass
+
     #如果没__setattr__就来获取
     def getValueOrDefault(self, key):
         value = getattr(self, key, None)
@@ -158,85 +1053,308 @@ class Model(dict,metaclass=ModelMetaClass):
         return value
 
     @classmethod
-    @asyncio.coroutine
-    def findAll(cls, where=None, args=None, **kw):
-        sql = [cls.__select__]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        if args is None:
-            args = []
-        orderBy = kw.get('orderBy', None)
-        if orderBy:
-            sql.append('order by')
-            sql.append(orderBy)
+    async def findAll(cls, where=None, args=None, **kw):
+        '''
+        after=(created_at, id) 时使用 keyset 分页，返回该游标之后的记录 (created_at desc, id desc)，不能再指定别的 orderBy
+        columns=[...] 或 Projection 时只查这些列，其余列用 load() 补齐
+        cache=True 或 TTL 秒数时结果放进 query_cache，本表有写入时失效
+
+        preload=['comments'] / preload_counts=['comments'] 时用一条查询取出所有子记录 / 子记录数，见 preload()
+        '''
+        columns = cls._columns(kw.get('columns', None))
+        args = list(args) if args else []
+        after = kw.get('after', None)
+        if after is not None:
+            if len(after) != 2:
+                raise ValueError('Invalid after value: %s' % str(after))
+            # 游标条件只对 created_at desc, id desc 成立，别的排序会跳过或重复记录
+            if kw.get('orderBy', None) not in (None, KEYSET_ORDER_BY):
+                raise ValueError('orderBy must be %s with after: %s' % (KEYSET_ORDER_BY, kw['orderBy']))
+            args.extend(after)
         limit = kw.get('limit', None)
-        if limit is not None:
-            sql.append('limit')
-            if isinstance(limit, int):
-                sql.append('?')
-                args.append(limit)
-            elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?,?')
-                args.extend(limit)
+        if limit is None:
+            kind = 0
+        elif isinstance(limit, int):
+            kind = 1
+            args.append(limit)
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            kind = 2
+            args.extend(limit)
+        else:
+            raise ValueError('Invalid limit value: %s' % str(limit))
+        sql = _find_all_sql(cls, where, kw.get('orderBy', None), kind, after is not None, columns)
+        rs = await _cached_select(cls.__table__, sql, args, cache=kw.get('cache', None))
+        if columns is not None:
+            L = cls._partial(columns, rs)
+        else:
+            L = cls._hydrate(rs) #rs 是list,每个r 都是返回的一个字典记录
+        preload, counts = kw.get('preload', None), kw.get('preload_counts', None)
+        if preload or counts:
+            await cls.preload(L, preload or (), counts or (), cache=kw.get('cache', None))
+        return L
+
+    @classmethod
+    async def preload(cls, objs, relations=(), counts=(), cache=None):
+        '''
+        Attach child rows of relation as obj.<relation> (list) and child counts as obj.<relation>_count,
+        one query per relation for all objs. Relations are declared on the child's field, e.g.
+        Comment.blog_id = StringField(references='Blog') gives Blog the relation 'comments'.
+        '''
+        if not objs:
+            return objs
+        declared = _relations[cls.__model__.__name__]
+        pks = list(dict.fromkeys(obj.getValue(cls.__primary_key__) for obj in objs))
+        n, args = _padded(pks)
+        for name in relations:
+            if name not in declared:
+                raise ValueError('Invalid relation: %s'%name)
+            child, fk = declared[name]
+            rs = await _cached_select(child.__table__, _children_sql(child, fk, n), args, cache=cache)
+            groups = collections.defaultdict(list)
+            for r in child._hydrate(rs):
+                groups[r.getValue(fk)].append(r)
+            for obj in objs:
+                setattr(obj, name, groups.get(obj.getValue(cls.__primary_key__), []))
+        for name in counts:
+            if name not in declared:
+                raise ValueError('Invalid relation: %s'%name)
+            child, fk = declared[name]
+            if child.__counted__:
+                found = dict(zip(pks, (await counter_values(child.counter(**{fk: pk}) for pk in pks))))
             else:
-                raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = yield from select(' '.join(sql), args)
-        return [cls(**r) for r in rs] #rs 是list,每个r 都是返回的一个字典记录
+                rs = await _cached_select(child.__table__, _children_count_sql(child, fk, n), args, cache=cache)
+                found = dict((r['_fk_'], r['_num_']) for r in rs)
+            for obj in objs:
+                setattr(obj, '%s_count'%name, found.get(obj.getValue(cls.__primary_key__), 0))
+        return objs
 
     @classmethod
-    @asyncio.coroutine
-    def findNumber(cls, selectField, where=None, args=None):
-        sql = ['select %s _num_ from `%s`'%(selectField, cls.__table__)]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        rs = yield from select(' '.join(sql),args, 1)
+    def stream(cls, where=None, args=None, batch_size=1000, **kw):
+        '''
+        Like findAll() but return a ModelStream, only batch_size rows are held in memory.
+        '''
+        return ModelStream(cls, _find_all_sql(cls, where, kw.get('orderBy', None), 0), args, batch_size)
+
+    @classmethod
+    def counter(cls, **where):
+        '''
+        Name of the row counter of the table, or of one parent with fk=value, e.g. Comment.counter(blog_id=id).
+        '''
+        if not where:
+            return cls.__table__
+        if len(where) != 1 or next(iter(where)) not in cls.__counted_by__:
+            raise ValueError('Invalid counter: %s'%where)
+        (fk, value), = where.items()
+        return '%s.%s:%s'%(cls.__table__, fk, value)
+
+    def _counter_deltas(self, delta):
+        if not self.__counted__:
+            return []
+        L = [(self.__table__, delta)]
+        for fk in self.__counted_by__:
+            value = self.getValue(fk)
+            if value is not None:
+                L.append(('%s.%s:%s'%(self.__table__, fk, value), delta))
+        return L
+
+    @classmethod
+    async def count(cls, **where):
+        '''
+        Row count of the table, or of one parent (see counter()), from the maintained counters.
+        Models without __counted__ run count() on the table.
+        '''
+        if cls.__counted__:
+            return (await counter_values([cls.counter(**where)]))[0]
+        return await cls.findNumber('count(`%s`)'%cls.__primary_key__,
+                                    ' and '.join('`%s`=?'%k for k in where) or None, list(where.values()))
+
+    @classmethod
+    async def findNumber(cls, selectField, where=None, args=None, cache=None):
+        rs = await _cached_select(cls.__table__, _find_number_sql(cls, selectField, where), args, 1, cache)
         if len(rs) == 0:
             return None
         return rs[0]['_num_']
 
     @classmethod
-    @asyncio.coroutine
-    def find(cls, pk):
-        rs = yield from select('%s where `%s`=?'%(cls.__select__, cls.__primary_key__),[pk],1)
-        if len(rs) == 0:
+    async def find(cls, pk):
+        # 事务里或者本请求已钉在主库上时直接查，否则和同一轮事件循环里的其它 find 合并成一次查询
+        if _transaction.get() is not None or _read_primary.get():
+            rs = await _select(cls.__compiled__['find'], [pk], 1)
+            r = rs[0] if rs else None
+        else:
+            # shield: 一个调用方被取消不影响共用这次查询的其它调用方
+            r = await asyncio.shield(cls.__loader__.load(pk))
+        if r is None:
             return None
-        return cls(**rs[0])
+        return cls.__hydrate__((r,))[0]
 
-    @asyncio.coroutine
-    def save(self):
-        args = list(map(self.getValueOrDefault, self.__fields__))
-        args.append(self.getValueOrDefault(self.__primary_key__))
-        rows = yield from execute(self.__insert__, args)
+    async def save(self):
+        args = self.__insert_args__()
+        rows = await _with_counters(lambda: _execute(self.__compiled__['insert'], args, table=self.__table__), self._counter_deltas(1))
         if rows != 1:
             logging.warning('failed to insert record: affected rows: %s'%rows)
+        self._clean()
+
+    @classmethod
+    async def save_many(cls, objs, chunk_size=1000):
+        '''
+        批量插入：每 chunk_size 行拼成一条多行 insert，所有分块在同一个连接的同一个事务里执行
+        '''
+        objs = list(objs)
+        if not objs:
+            return 0
+        def chunks():
+            for i in range(0, len(objs), chunk_size):
+                chunk = objs[i:i + chunk_size]
+                args = []
+                for obj in chunk:
+                    args.extend(obj.__insert_args__())
+                yield _insert_many_sql(cls, len(chunk)), args
+        deltas = collections.Counter()
+        for obj in objs:
+            deltas.update(dict(obj._counter_deltas(1)))
+        rows = await _with_counters(lambda: _execute_many(chunks(), cls.__table__), list(deltas.items()))
+        if rows != len(objs):
+            logging.warning('failed to insert records: affected rows: %s, expected: %s'%(rows, len(objs)))
+        return rows
 
-    @asyncio.coroutine
-    def update(self):
-        args = list(map(self.getValue, self.__fields__))
-        args.append(self.getValue(self.__primary_key__))
-        rows = yield from execute(self.__update__, args)
+    async def update(self):
+        '''
+        Write the row back: a row object writes only the columns assigned since it was read,
+        a dict based Model (no tracking, _dirty() is None) writes every column.
+        >>> class T(Model):
+        ...     id = StringField(primary_key=True)
+        ...     name = StringField()
+        ...     note = StringField()
+        >>> T(id='1', name='a')._dirty() is None
+        True
+        >>> r = T.__row__._from_dict(dict(id='1', name='a', note='n'))
+        >>> r.name, r.note = 'b', 'n'
+        >>> sorted(r._dirty())
+        ['name']
+        '''
+        dirty = self._dirty()
+        if dirty is None:
+            # 不跟踪修改的对象写所有列；部分加载的对象先补齐，否则没查出来的列会被写成 NULL
+            await self.load()
+            sql, args = self.__compiled__['update'], self.__update_args__()
+        else:
+            # 只写改过的列，一列都没改就不访问数据库
+            fields = tuple(f for f in self.__fields__ if f in dirty)
+            if not fields:
+                logging.debug('nothing to update: %s %s' % (self.__table__, self.getValue(self.__primary_key__)))
+                return
+            sql, update_args = _update_plan(self.__row__, fields)
+            args = update_args(self)
+        rows = await _execute(sql, args, table=self.__table__)
         if rows != 1:
             logging.warning('failed to update by primarykey: affected rows: %s' % rows)
+        self._clean()
 
-    @asyncio.coroutine
-    def remove(self):
+    async def remove(self):
+        if self.__counted__:
+            await self.load(*self.__counted_by__) # 部分加载的对象要知道父记录才能减计数
         args = [self.getValue(self.__primary_key__)]
-        rows = yield from execute(self.__delete__, args)
+        rows = await _with_counters(lambda: _execute(self.__compiled__['delete'], args, table=self.__table__), self._counter_deltas(-1))
         if rows != 1:
             logging.warning('failef to remove bu primary key：affected rows: %s'%rows)
 
+# ModelBase 要排在 dict 前面，否则 update() 会找到 dict.update
+class Model(ModelBase, dict, metaclass=ModelMetaClass):
+    '''
+    Dict based model: Blog(name=...) is a dict whose keys are the columns.
+    >>> Model.update is ModelBase.update, Model.get is dict.get
+    (True, True)
+    '''
+    def __init__(self, **kw):
+        super(Model, self).__init__(**kw)
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            if key in self.__dict__.get('__missing__', ()):
+                raise AttributeError(r"'%s' is not loaded, call load() first"%key)
+            raise AttributeError(r"'Model' object has no attribute '%s'"%key)
+
+    def __setattr__(self, key, value):
+        self[key] = value
 
+_new_row = object.__new__
+_set = object.__setattr__
+_CLEAN = frozenset()
 
+class ModelRow(ModelBase):
+    '''
+    Compact row class generated for each model as Model.__row__: one slot per column instead of a dict.
+    Extra attributes (e.g. html_content) go into a lazily created __dict__.
+    Columns assigned a different value since the row was read are tracked for update().
+    '''
+    __slots__ = ('__dict__', '__dirty__')
 
+    def __init__(self, **kw):
+        for k, v in kw.items():
+            setattr(self, k, v)
 
+    @classmethod
+    def _from_dict(cls, r):
+        obj = _new_row(cls)
+        for k, v in r.items():
+            _set(obj, k, v)
+        return obj
 
+    def __setattr__(self, key, value):
+        if key in self.__mappings__ and getattr(self, key, _new_row) != value:
+            dirty = getattr(self, '__dirty__', None)
+            if dirty is None:
+                dirty = set()
+                _set(self, '__dirty__', dirty)
+            dirty.add(key)
+        _set(self, key, value)
+
+    def _dirty(self):
+        return getattr(self, '__dirty__', None) or _CLEAN
 
+    def _clean(self):
+        _set(self, '__dirty__', None)
 
+    # 只有 slot 没有赋值或者属性不存在时才会调用
+    def __getattr__(self, key):
+        if key in self.__dict__.get('__missing__', ()):
+            raise AttributeError(r"'%s' is not loaded, call load() first"%key)
+        raise AttributeError(r"'Model' object has no attribute '%s'"%key)
 
+    def to_dict(self):
+        '''
+        Same content as the dict based Model: loaded columns plus extra attributes.
+        '''
+        d = dict()
+        for k in self.__columns__:
+            v = getattr(self, k, _new_row)
+            if v is not _new_row:
+                d[k] = v
+        for k, v in self.__dict__.items():
+            if not k.startswith('__'):
+                d[k] = v
+        return d
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
 
+    def get(self, key, default=None):
+        return getattr(self, key, default)
 
+    def keys(self):
+        return self.to_dict().keys()
 
+    def items(self):
+        return self.to_dict().items()
 
+    def __iter__(self):
+        return iter(self.to_dict())
 
+    def __repr__(self):
+        return repr(self.to_dict())
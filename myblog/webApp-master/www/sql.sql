@@ -22,7 +22,7 @@ create table users (
 ) engine=innodb default charset=utf8;
 
 create table blogs (
-    `id` varchar(50) not null,
+    `id` varchar(16) not null,
     `user_id` varchar(50) not null,
     `user_name` varchar(50) not null,
     `user_image` varchar(500) not null,
@@ -35,13 +35,21 @@ create table blogs (
 ) engine=innodb default charset=utf8;
 
 create table comments (
-    `id` varchar(50) not null,
-    `blog_id` varchar(50) not null,
+    `id` varchar(16) not null,
+    `blog_id` varchar(16) not null,
     `user_id` varchar(50) not null,
     `user_name` varchar(50) not null,
     `user_image` varchar(500) not null,
     `content` mediumtext not null,
     `created_at` real not null,
+    key `idx_blog_id` (`blog_id`),
     key `idx_created_at` (`created_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
+
+-- 表的行数和每篇博客的评论数，见 orm 的计数器 (Model.count())
+create table counters (
+    `name` varchar(100) not null,
+    `value` bigint not null,
+    primary key (`name`)
+) engine=innodb default charset=utf8;